@@ -0,0 +1,149 @@
+import os
+import hashlib
+import sqlite3
+from datetime import datetime
+from typing import List, Dict, Optional, Any
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def file_digest(path: str) -> str:
+    """输入文件内容的 sha256，用于判断同一路径下的输入文件是否已被新内容覆盖"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class BatchLedger:
+    """
+    基于 SQLite 的 Batch 任务台账。
+
+    每个 Batch 记录：输入文件及其内容摘要、custom_id 范围、当前状态、输出/错误文件 id、提交与更新时间；
+    每次状态变化额外写入 status_transitions 表。进程崩溃重启后可据此继续轮询未完成的 Batch，
+    而不是重新提交。
+    """
+
+    def __init__(self, db_path: str = "data/batch_ledger.sqlite3"):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_id TEXT PRIMARY KEY,
+                    input_file TEXT NOT NULL,
+                    first_item_id TEXT,
+                    last_item_id TEXT,
+                    num_items INTEGER,
+                    status TEXT NOT NULL,
+                    output_file_id TEXT,
+                    error_file_id TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    input_hash TEXT
+                )
+            """)
+            # 旧版本创建的台账没有 input_hash 列
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(batches)")}
+            if "input_hash" not in columns:
+                self.conn.execute("ALTER TABLE batches ADD COLUMN input_hash TEXT")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS status_transitions (
+                    batch_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    changed_at TEXT NOT NULL
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_batches_input_file ON batches (input_file)")
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now().isoformat(timespec="seconds")
+
+    def record_submission(self,
+                          batch_id: str,
+                          input_file: str,
+                          first_item_id: Optional[str] = None,
+                          last_item_id: Optional[str] = None,
+                          num_items: Optional[int] = None,
+                          status: str = "validating",
+                          input_hash: Optional[str] = None):
+        """登记一个新提交的 Batch"""
+        now = self._now()
+        with self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO batches (batch_id, input_file, first_item_id, last_item_id, num_items,
+                   status, output_file_id, error_file_id, created_at, updated_at, input_hash)
+                   VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?, ?, ?)""",
+                (batch_id, input_file, first_item_id, last_item_id, num_items, status, now, now, input_hash))
+            self.conn.execute(
+                "INSERT INTO status_transitions VALUES (?, ?, ?)", (batch_id, status, now))
+
+    def update_status(self,
+                      batch_id: str,
+                      status: str,
+                      output_file_id: Optional[str] = None,
+                      error_file_id: Optional[str] = None):
+        """更新 Batch 状态，状态发生变化时记录一次状态转移"""
+        row = self.get_batch(batch_id)
+        if row is None:
+            return
+        now = self._now()
+        with self.conn:
+            self.conn.execute(
+                """UPDATE batches SET status = ?, output_file_id = COALESCE(?, output_file_id),
+                   error_file_id = COALESCE(?, error_file_id), updated_at = ? WHERE batch_id = ?""",
+                (status, output_file_id, error_file_id, now, batch_id))
+            if row["status"] != status:
+                self.conn.execute(
+                    "INSERT INTO status_transitions VALUES (?, ?, ?)", (batch_id, status, now))
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            "SELECT * FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_latest_batch(self, input_file: str, input_hash: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        返回某个输入文件最近一次提交的 Batch (用于重启后决定是继续轮询还是跳过)。
+        指定 input_hash 时只匹配以相同内容提交的 Batch：同一路径的输入文件每次运行都会重写，只比较路径会误用旧内容的结果。
+        """
+        if input_hash is None:
+            row = self.conn.execute(
+                "SELECT * FROM batches WHERE input_file = ? ORDER BY created_at DESC, rowid DESC LIMIT 1",
+                (input_file,)).fetchone()
+        else:
+            row = self.conn.execute(
+                "SELECT * FROM batches WHERE input_file = ? AND input_hash = ? "
+                "ORDER BY created_at DESC, rowid DESC LIMIT 1",
+                (input_file, input_hash)).fetchone()
+        return dict(row) if row else None
+
+    def latest_batch_id(self) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT batch_id FROM batches ORDER BY created_at DESC, rowid DESC LIMIT 1").fetchone()
+        return row["batch_id"] if row else None
+
+    def in_flight_batches(self) -> List[Dict[str, Any]]:
+        """所有尚未进入终止状态的 Batch"""
+        rows = self.conn.execute(
+            f"SELECT * FROM batches WHERE status NOT IN ({','.join('?' * len(TERMINAL_STATUSES))}) "
+            "ORDER BY created_at",
+            TERMINAL_STATUSES).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_batches(self) -> List[Dict[str, Any]]:
+        rows = self.conn.execute(
+            "SELECT * FROM batches ORDER BY created_at, rowid").fetchall()
+        return [dict(row) for row in rows]
+
+    def get_transitions(self, batch_id: str) -> List[Dict[str, Any]]:
+        rows = self.conn.execute(
+            "SELECT status, changed_at FROM status_transitions WHERE batch_id = ? ORDER BY rowid",
+            (batch_id,)).fetchall()
+        return [dict(row) for row in rows]
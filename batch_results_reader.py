@@ -0,0 +1,235 @@
+import io
+import json
+from typing import List, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as paj
+
+RESULT_SCHEMA = pa.schema([
+    ("custom_id", pa.string()),
+    ("status_code", pa.int64()),
+    ("error", pa.string()),
+    ("text", pa.string()),
+])
+
+REJECT_SCHEMA = pa.schema([
+    ("custom_id", pa.string()),
+    ("stage", pa.string()),
+    ("reason", pa.string()),
+    ("raw", pa.string()),
+])
+
+BLOCK_SIZE = 64 << 20
+
+
+def _empty_rejects() -> pa.Table:
+    return REJECT_SCHEMA.empty_table()
+
+
+def _rejects(rows: List[dict]) -> pa.Table:
+    return pa.Table.from_pylist(rows, schema=REJECT_SCHEMA) if rows else _empty_rejects()
+
+
+def _field(array, name: str, length: int):
+    """读取 struct 字段，字段不存在时返回全空数组"""
+    if isinstance(array.type, pa.StructType) and array.type.get_field_index(name) != -1:
+        return pc.struct_field(array, name)
+    return pa.nulls(length)
+
+
+def _column(table: pa.Table, name: str):
+    if name in table.column_names:
+        return table[name].combine_chunks()
+    return pa.nulls(table.num_rows)
+
+
+def _errors_to_json(*errors) -> pa.Array:
+    """把 (可能是 struct 类型的) 错误列合并为 JSON 字符串列，取第一个非空的错误"""
+    merged = [None] * len(errors[0])
+    for error in errors:
+        if pa.types.is_null(error.type) or error.null_count == len(error):
+            continue
+        for i, value in enumerate(error.to_pylist()):
+            if merged[i] is None and value is not None:
+                merged[i] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    return pa.array(merged, type=pa.string())
+
+
+def _decode_table(table: pa.Table) -> pa.Table:
+    """在 Arrow 表上列式地抽取 custom_id / status_code / error / 第一条 message 的文本"""
+    n = table.num_rows
+    response = _column(table, "response")
+    body = _field(response, "body", n)
+    output = _field(body, "output", n)
+
+    texts = np.full(n, None, dtype=object)
+    if pa.types.is_list(output.type) and isinstance(output.type.value_type, pa.StructType):
+        flat = pc.list_flatten(output)
+        parents = pc.list_parent_indices(output).to_numpy()
+        content = _field(flat, "content", len(flat))
+        is_message = pc.equal(_field(flat, "type", len(flat)), "message")
+        if pa.types.is_list(content.type):
+            is_message = pc.and_(is_message, pc.greater(pc.list_value_length(content), 0))
+            is_message = pc.fill_null(is_message, False).to_numpy(zero_copy_only=False)
+            positions = np.flatnonzero(is_message)
+            if len(positions):
+                first_content = pc.list_element(pc.take(content, pa.array(positions)), 0)
+                message_texts = _field(first_content, "text", len(positions)).to_numpy(zero_copy_only=False)
+                message_parents = parents[positions]
+                # 每条记录只取第一条 message (parents 有序，取每组的第一个位置)
+                first = np.concatenate([[True], message_parents[1:] != message_parents[:-1]])
+                texts[message_parents[first]] = message_texts[first]
+
+    status_code = _field(response, "status_code", n)
+    return pa.table({
+        "custom_id": pc.cast(_column(table, "custom_id"), pa.string()),
+        "status_code": pc.cast(status_code, pa.int64()),
+        "error": _errors_to_json(_column(table, "error"), _field(body, "error", n)),
+        "text": pa.array(texts, type=pa.string()),
+    }, schema=RESULT_SCHEMA)
+
+
+def read_batch_results(path: str) -> Tuple[pa.Table, pa.Table]:
+    """
+    读取整个 Batch 结果文件，返回 (results, rejects) 两张表。
+
+    results 的列为 custom_id、status_code、error (JSON 字符串，成功时为空) 与 text (第一条 message 的文本)。
+    优先用 Arrow 的 JSON 读取器整体解析；文件中有无法解析的行或字段类型冲突时，
+    退回逐行解析，无法解析的行或缺少 custom_id 的行写入 rejects 而不是抛出异常。
+    """
+    try:
+        table = paj.read_json(path, read_options=paj.ReadOptions(block_size=BLOCK_SIZE))
+        if "custom_id" in table.column_names and table["custom_id"].null_count == 0:
+            return _decode_table(table), _empty_rejects()
+    except pa.ArrowInvalid:
+        pass
+
+    records = []
+    rejects = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                rejects.append({"custom_id": None, "stage": "envelope",
+                                "reason": f"line {line_number}: {e}", "raw": line[:1000]})
+                continue
+            if not isinstance(record, dict) or record.get("custom_id") is None:
+                rejects.append({"custom_id": None, "stage": "envelope",
+                                "reason": f"line {line_number}: missing custom_id", "raw": line[:1000]})
+                continue
+            records.append(record)
+
+    results = []
+    for record in records:
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        error = record.get("error") or body.get("error")
+        text = None
+        for out in body.get("output") or []:
+            if isinstance(out, dict) and out.get("type") == "message" and out.get("content"):
+                text = out["content"][0].get("text")
+                break
+        results.append({
+            "custom_id": str(record["custom_id"]),
+            "status_code": response.get("status_code"),
+            "error": None if error is None else (error if isinstance(error, str) else json.dumps(error, ensure_ascii=False)),
+            "text": text,
+        })
+    return pa.Table.from_pylist(results, schema=RESULT_SCHEMA), _rejects(rejects)
+
+
+def _normalize_payloads(texts: pa.Array) -> pa.Array:
+    """
+    去掉 markdown 代码块标记。不改动其余内容：多行 (pretty-printed) 的 JSON 由 newlines_in_values 解析，
+    字符串内的裸换行不是合法 JSON，应进入 rejects 而不是被改写。
+    """
+    return pc.replace_substring_regex(texts, r"^\s*```(?:json)?|```\s*$", "")
+
+
+def parse_json_payloads(custom_ids: pa.Array,
+                        texts: pa.Array,
+                        fields: List[str],
+                        stage: str = "payload") -> Tuple[pa.Table, pa.Table]:
+    """
+    批量解析模型输出文本中嵌入的 JSON (例如 perturbed_option / explanation)。
+
+    所有文本拼接为一个缓冲区交给 Arrow 一次解析 (允许 JSON 跨多行)；若有无法解析的文本，
+    先逐行定位坏行放入 rejects，再批量解析其余的行。缺少任一字段的行同样放入 rejects。
+    """
+    custom_ids = pa.array(custom_ids, type=pa.string()) if not isinstance(custom_ids, pa.Array) else custom_ids
+    texts = pa.array(texts, type=pa.string()) if not isinstance(texts, pa.Array) else texts
+    schema = pa.schema([(field, pa.string()) for field in fields])
+    rejects = []
+
+    present = pc.is_valid(texts)
+    for custom_id in pc.filter(custom_ids, pc.invert(present)).to_pylist():
+        rejects.append({"custom_id": custom_id, "stage": stage, "reason": "no message text", "raw": None})
+    custom_ids, texts = pc.filter(custom_ids, present), pc.filter(texts, present)
+    normalized = _normalize_payloads(texts)
+
+    def bulk_parse(lines: pa.Array) -> pa.Table:
+        buffer = "\n".join(lines.to_pylist()).encode("utf-8")
+        return paj.read_json(io.BytesIO(buffer),
+                             read_options=paj.ReadOptions(block_size=max(BLOCK_SIZE, len(buffer) + 1)),
+                             parse_options=paj.ParseOptions(explicit_schema=schema,
+                                                            unexpected_field_behavior="ignore",
+                                                            newlines_in_values=True))
+
+    try:
+        parsed = bulk_parse(normalized) if len(normalized) else schema.empty_table()
+        if parsed.num_rows != len(normalized):
+            raise pa.ArrowInvalid("row count mismatch")
+    except pa.ArrowInvalid:
+        good = []
+        for i, line in enumerate(normalized.to_pylist()):
+            try:
+                value = json.loads(line)
+                good.append(isinstance(value, dict))
+                reason = "payload is not a JSON object"
+            except json.JSONDecodeError as e:
+                good.append(False)
+                reason = str(e)
+            if not good[-1]:
+                rejects.append({"custom_id": custom_ids[i].as_py(), "stage": stage,
+                                "reason": reason, "raw": texts[i].as_py()})
+        mask = pa.array(good, type=pa.bool_())
+        custom_ids, texts, normalized = pc.filter(custom_ids, mask), pc.filter(texts, mask), pc.filter(normalized, mask)
+        try:
+            parsed = bulk_parse(normalized) if len(normalized) else schema.empty_table()
+        except pa.ArrowInvalid:
+            # 字段类型与 string 不符 (例如嵌套对象) 时逐行构造，非字符串的值保留为 JSON 字符串
+            rows = []
+            for line in normalized.to_pylist():
+                value = json.loads(line)
+                rows.append({field: value.get(field) if isinstance(value.get(field), (str, type(None)))
+                             else json.dumps(value.get(field), ensure_ascii=False) for field in fields})
+            parsed = pa.Table.from_pylist(rows, schema=schema)
+
+    complete = pa.array(np.ones(parsed.num_rows, dtype=bool))
+    for field in fields:
+        complete = pc.and_(complete, pc.is_valid(parsed[field]))
+    for custom_id, raw in zip(pc.filter(custom_ids, pc.invert(complete)).to_pylist(),
+                              pc.filter(texts, pc.invert(complete)).to_pylist()):
+        rejects.append({"custom_id": custom_id, "stage": stage, "reason": "missing field", "raw": raw})
+
+    payloads = pc.filter(parsed, complete)
+    payloads = payloads.add_column(0, "custom_id", pc.filter(custom_ids, complete))
+    return payloads, _rejects(rejects)
+
+
+def read_batch_payloads(path: str, fields: List[str]) -> Tuple[pa.Table, pa.Table, pa.Table]:
+    """
+    读取 Batch 结果文件并解析嵌入的 JSON，返回 (payloads, errors, rejects)：
+    payloads 为成功解析的 custom_id + fields，errors 为请求本身失败的记录，rejects 为格式错误的记录。
+    """
+    results, rejects = read_batch_results(path)
+    failed = pc.is_valid(results["error"])
+    errors = pc.filter(results, failed)
+    ok = pc.filter(results, pc.invert(failed))
+    payloads, payload_rejects = parse_json_payloads(ok["custom_id"].combine_chunks(), ok["text"].combine_chunks(), fields)
+    return payloads, errors, pa.concat_tables([rejects, payload_rejects])
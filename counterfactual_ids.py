@@ -0,0 +1,103 @@
+import numpy as np
+from typing import List, Tuple
+
+
+_byte_length_tables = {}
+
+
+def token_byte_length_table(tokenizer) -> np.ndarray:
+    """
+    词表中每个 token 解码后的 UTF-8 字节数 (每个 tokenizer 只构建一次)。byte-level BPE (Qwen3) 的 token 字符串中
+    每个字符对应一个字节，special/added token 按其内容计算；无法按字节还原的 token 记为 -1。
+    """
+    table = _byte_length_tables.get(id(tokenizer))
+    if table is None:
+        from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+        byte_chars = frozenset(bytes_to_unicode().values())
+        size = max(len(tokenizer), max(tokenizer.added_tokens_decoder, default=-1) + 1)
+        tokens = tokenizer.convert_ids_to_tokens(list(range(size)))
+        table = np.array([len(token) if token is not None and byte_chars.issuperset(token) else -1
+                          for token in tokens], dtype=np.int64)
+        for i, token in tokenizer.added_tokens_decoder.items():
+            table[i] = len(token.content.encode("utf-8"))
+        _byte_length_tables[id(tokenizer)] = table
+    return table
+
+
+def token_prefix(tokenizer, ids: List[int], text: str, max_chars: int) -> Tuple[int, int]:
+    """
+    在 ids 中找到解码后不超过 max_chars 个字符、且与 text 开头一致的最长前缀，返回 (token 数, 字符数)。
+    text 为 ids 的完整解码结果 (skip_special_tokens=False)。
+
+    先查表得到每个 token 的字节数并累加，在 max_chars 个字符对应的字节位置二分查找一次；若有无法按字节还原的 token，
+    或 token 字节数之和与 text 的字节数不一致 (解码时做了额外清理)，退回逐次解码的二分查找。
+    """
+    table = token_byte_length_table(tokenizer)
+    token_ids = np.asarray(ids, dtype=np.int64)
+    lengths = table[token_ids] if len(token_ids) and token_ids.max() < len(table) else np.full(len(token_ids), -1)
+    encoded = text.encode("utf-8")
+    if (lengths >= 0).all() and int(lengths.sum()) == len(encoded):
+        ends = np.concatenate([[0], np.cumsum(lengths)])
+        k = int(np.searchsorted(ends, len(text[:max_chars].encode("utf-8")), side="right")) - 1
+        # 多字节字符被切开时向前退到完整的字符边界 (UTF-8 续字节为 0b10xxxxxx)
+        while k > 0 and ends[k] < len(encoded) and (encoded[ends[k]] & 0xC0) == 0x80:
+            k -= 1
+        return k, len(encoded[:ends[k]].decode("utf-8"))
+    return _decoded_token_prefix(tokenizer, ids, text, max_chars)
+
+
+def _decoded_token_prefix(tokenizer, ids: List[int], text: str, max_chars: int) -> Tuple[int, int]:
+    """token_prefix 的通用实现：对前缀逐次解码做二分查找"""
+    def decoded_length(k):
+        return len(tokenizer.decode(ids[:k], skip_special_tokens=False))
+
+    # 解码长度随 token 数单调不减，二分查找最后一个不超过 max_chars 的位置
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if decoded_length(mid) <= max_chars:
+            lo = mid
+        else:
+            hi = mid - 1
+    # 多字节字符被切开时解码结果含替换字符，向前退到完整的字符边界
+    while lo > 0:
+        decoded = tokenizer.decode(ids[:lo], skip_special_tokens=False)
+        if text.startswith(decoded):
+            return lo, len(decoded)
+        lo -= 1
+    return 0, 0
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    """两个字符串公共前缀的长度：对前缀是否相等做二分查找，每次比较都是 C 层面的切片比较"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def splice_counterfactual_ids(tokenizer, full_ids: List[int], full_text: str, counterfactual: str) -> List[int]:
+    """
+    由原始生成的 full_ids 构造反事实输入的 token ids：保留 full_ids 中与反事实文本公共前缀内的最长 token 前缀，
+    只对剩余的文本 (截断点前不足一个 token 的部分 + 插入的文本) 分词后拼接，
+    使反事实输入与原始运行的前缀 token 完全一致，且无需对整条反事实文本重新分词。
+    """
+    common = common_prefix_length(full_text, counterfactual)
+    k, chars = token_prefix(tokenizer, full_ids, full_text, common)
+    return list(full_ids[:k]) + tokenizer(counterfactual[chars:], add_special_tokens=False).input_ids
+
+
+_tokenizer = None
+
+
+def worker_tokenizer():
+    """并行任务中使用的 Qwen3 tokenizer，每个进程只加载一次"""
+    global _tokenizer
+    if _tokenizer is None:
+        from qwen3_generation import MODEL_ID, load_tokenizer
+        _tokenizer = load_tokenizer(MODEL_ID)
+    return _tokenizer
@@ -0,0 +1,174 @@
+import os
+import json
+import heapq
+import argparse
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as paj
+
+
+def load_prior_lengths(path: str) -> Dict[int, int]:
+    """从之前运行的结果文件读取每个 id 的完整序列长度 (len(full_ids))，同一 id 有多个采样时取平均"""
+    if not path or not os.path.exists(path):
+        return {}
+    table = paj.read_json(path, read_options=paj.ReadOptions(block_size=64 << 20), parse_options=paj.ParseOptions(
+        explicit_schema=pa.schema([("id", pa.int64()), ("full_ids", pa.list_(pa.int64()))]),
+        unexpected_field_behavior="ignore"))
+    ids = table["id"].to_numpy()
+    lengths = pc.list_value_length(table["full_ids"]).to_numpy(zero_copy_only=False)
+    totals: Dict[int, List[int]] = {}
+    for i, length in zip(ids.tolist(), lengths.tolist()):
+        totals.setdefault(i, []).append(length)
+    return {i: int(np.mean(values)) for i, values in totals.items()}
+
+
+def predict_output_lengths(ids: Sequence[int],
+                           prompt_lengths: Sequence[int],
+                           prior_lengths: Dict[int, int],
+                           max_new_tokens: int) -> List[int]:
+    """
+    预测每个样本的输出 token 数：
+    - 之前运行过的 id：之前的完整序列长度减去本次输入长度 (反事实输入包含部分原 trace，剩余部分即为预计输出)
+    - 其余 id：已知样本预测值的中位数；没有任何历史数据时为 max_new_tokens (此时只按输入长度排序)
+    """
+    known = [prior_lengths[i] - length for i, length in zip(ids, prompt_lengths) if i in prior_lengths]
+    fallback = int(np.median(known)) if known else max_new_tokens
+    predicted = []
+    for i, length in zip(ids, prompt_lengths):
+        value = prior_lengths[i] - length if i in prior_lengths else fallback
+        predicted.append(int(min(max(value, 1), max_new_tokens)))
+    return predicted
+
+
+def longest_first_order(predicted: Sequence[int], prompt_lengths: Sequence[int]) -> List[int]:
+    """按预测的完整长度 (输入 + 输出) 从长到短排列，相近长度的样本相邻，组批时 padding 更少"""
+    return sorted(range(len(predicted)), key=lambda i: (-(predicted[i] + prompt_lengths[i]), i))
+
+
+def batch_costs(batches: List[List[int]], predicted: Sequence[int]) -> List[int]:
+    """一批的耗时按 decode 步数近似，即批内最长的输出 (批内所有序列都要等最长的一条结束)"""
+    return [max(predicted[i] for i in batch) for batch in batches]
+
+
+def lpt_assign(costs: Sequence[int], num_workers: int) -> List[List[int]]:
+    """LPT (longest processing time first)：按耗时从大到小，每次把批次交给当前负载最小的 worker"""
+    workers = [(0, w) for w in range(num_workers)]
+    assignment: List[List[int]] = [[] for _ in range(num_workers)]
+    for b in sorted(range(len(costs)), key=lambda b: -costs[b]):
+        load, w = heapq.heappop(workers)
+        assignment[w].append(b)
+        heapq.heappush(workers, (load + costs[b], w))
+    return assignment
+
+
+def arrival_assign(num_batches: int, num_workers: int) -> List[List[int]]:
+    """按到达顺序把批次平均切成连续的分片 (未调度时的分片方式)"""
+    bounds = np.linspace(0, num_batches, num_workers + 1).astype(int)
+    return [list(range(bounds[w], bounds[w + 1])) for w in range(num_workers)]
+
+
+def makespan(assignment: List[List[int]], costs: Sequence[int]) -> int:
+    return max((sum(costs[b] for b in batches) for batches in assignment), default=0)
+
+
+def padding_waste(batches: List[List[int]], lengths: Sequence[int]) -> Dict[str, float]:
+    """批内按最长序列补齐时浪费的 token 数及其占比"""
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    used = sum(lengths[i] for batch in batches for i in batch)
+    return {"padding_tokens": padded - used, "padding_fraction": (padded - used) / padded if padded else 0.0}
+
+
+def schedule_report(arrival_batches: List[List[int]],
+                    scheduled_batches: List[List[int]],
+                    predicted: Sequence[int],
+                    prompt_lengths: Sequence[int],
+                    num_workers: int) -> Dict[str, float]:
+    """对比按到达顺序与按长度调度的 padding 浪费与 makespan (单位均为近似的 decode 步数/token 数)"""
+    totals = [p + o for p, o in zip(prompt_lengths, predicted)]
+    arrival_costs = batch_costs(arrival_batches, predicted)
+    scheduled_costs = batch_costs(scheduled_batches, predicted)
+    arrival_makespan = makespan(arrival_assign(len(arrival_batches), num_workers), arrival_costs)
+    scheduled_makespan = makespan(lpt_assign(scheduled_costs, num_workers), scheduled_costs)
+    arrival_waste = padding_waste(arrival_batches, totals)
+    scheduled_waste = padding_waste(scheduled_batches, totals)
+    return {
+        "num_items": len(predicted),
+        "num_workers": num_workers,
+        "arrival_padding_fraction": arrival_waste["padding_fraction"],
+        "scheduled_padding_fraction": scheduled_waste["padding_fraction"],
+        "arrival_makespan": arrival_makespan,
+        "scheduled_makespan": scheduled_makespan,
+        "makespan_speedup": arrival_makespan / scheduled_makespan if scheduled_makespan else None,
+    }
+
+
+def plan_schedule(ids: Sequence[int],
+                  prompt_lengths: Sequence[int],
+                  prior_lengths: Dict[int, int],
+                  max_new_tokens: int,
+                  plan_batches,
+                  num_workers: int = 1,
+                  worker_index: int = 0,
+                  report: Optional[Dict[str, float]] = None) -> List[List[int]]:
+    """
+    输出长度感知的调度：预测输出长度，按预测长度从长到短组批 (相近长度同批)，
+    再用 LPT 把批次分给 num_workers 个 worker，返回第 worker_index 个 worker 要执行的批次 (样本下标，最长的在前)。
+
+    plan_batches(lengths) 为组批函数 (例如按显存预算的 plan_memory_batches)，输入按顺序排列的输入长度，返回下标分组。
+    传入 report 时写入与按到达顺序组批、连续分片相比的 padding 浪费与 makespan。
+    """
+    predicted = predict_output_lengths(ids, prompt_lengths, prior_lengths, max_new_tokens)
+    order = longest_first_order(predicted, prompt_lengths)
+    scheduled_batches = [[order[j] for j in batch] for batch in plan_batches([prompt_lengths[i] for i in order])]
+    costs = batch_costs(scheduled_batches, predicted)
+    assignment = lpt_assign(costs, num_workers)
+    if report is not None:
+        report.update(schedule_report(plan_batches(list(prompt_lengths)), scheduled_batches,
+                                      predicted, prompt_lengths, num_workers))
+    # LPT 分配的结果已按耗时从大到小排列
+    return [scheduled_batches[b] for b in assignment[worker_index]]
+
+
+def shard_path(path: str, worker_index: int, num_workers: int) -> str:
+    if num_workers == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{worker_index}{ext}"
+
+
+def merge_results_by_id(paths: List[str], output_path: str):
+    """
+    把 (可能来自多个分片、按调度顺序写入的) 结果文件按 (id, sample_idx) 排序合并，使下游脚本仍按 id 顺序读取。
+    只读取每行的 id 与文件偏移，再按偏移逐行复制，不在内存中保留完整记录。
+    """
+    keys = []
+    for path_index, path in enumerate(paths):
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                record = json.loads(line)
+                keys.append((record["id"], record.get("sample_idx", 0), path_index, offset))
+                offset += len(line)
+    keys.sort()
+    tmp_path = output_path + ".tmp"
+    files = [open(path, "rb") for path in paths]
+    try:
+        with open(tmp_path, "wb") as out:
+            for _, _, path_index, offset in keys:
+                files[path_index].seek(offset)
+                out.write(files[path_index].readline())
+    finally:
+        for f in files:
+            f.close()
+    os.replace(tmp_path, output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按 id 合并按长度调度写入的结果分片")
+    parser.add_argument("output")
+    parser.add_argument("shards", nargs="+")
+    args = parser.parse_args()
+    merge_results_by_id(args.shards, args.output)
@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import time
+import torch
+from typing import Dict, Optional
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+from transformers.modeling_utils import no_init_weights
+from huggingface_hub.constants import HF_HUB_CACHE
+from huggingface_hub.file_download import repo_folder_name
+
+CACHE_DIR = "data/model_cache"
+WEIGHTS_FILE = "model.safetensors"
+META_FILE = "snapshot_meta.json"
+
+
+def snapshot_dir(model_id: str, dtype: str = "bfloat16", cache_dir: str = CACHE_DIR) -> str:
+    """每个 (模型, dtype) 对应一个快照目录"""
+    return os.path.join(cache_dir, re.sub(r"[^\w.-]+", "--", model_id).strip("-") + f"--{dtype}")
+
+
+def local_revision(model_id: str) -> Optional[str]:
+    """
+    本地 HF 缓存中模型 main 分支当前指向的 commit hash (读取 refs/main，不访问网络)。
+    本地目录或缓存中没有该模型时为 None。
+    """
+    ref = os.path.join(HF_HUB_CACHE, repo_folder_name(repo_id=model_id, repo_type="model"), "refs", "main")
+    if not os.path.exists(ref):
+        return None
+    with open(ref, "r", encoding="utf-8") as f:
+        return f.read().strip() or None
+
+
+def build_snapshot(model_id: str, dtype: str = "bfloat16", cache_dir: str = CACHE_DIR) -> str:
+    """
+    把模型转换为本地快照：目标 dtype 的单个 safetensors 权重文件 (包括非持久化的 buffer，如 RoPE 的 inv_freq)，
+    以及 config、generation config 与 tokenizer。共享存储的权重 (tied embedding) 只保存一份并记录别名，
+    并在 meta 中记录构建时模型的 commit hash (revision)。
+    """
+    path = snapshot_dir(model_id, dtype, cache_dir)
+    os.makedirs(path, exist_ok=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id, dtype=getattr(torch, dtype), device_map="cpu", trust_remote_code=True)
+
+    tensors = {}
+    aliases = {}
+    seen = {}
+    buffers = []
+    persistent = set(model.state_dict())
+    named = list(model.state_dict().items()) + \
+        [(name, buffer) for name, buffer in model.named_buffers() if name not in persistent]
+    for name, tensor in named:
+        if name not in persistent:
+            buffers.append(name)
+        key = (tensor.data_ptr(), tuple(tensor.shape), tensor.dtype)
+        if key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        tensors[name] = tensor.detach().contiguous()
+    save_file(tensors, os.path.join(path, WEIGHTS_FILE))
+
+    model.config.save_pretrained(path)
+    if model.generation_config is not None:
+        model.generation_config.save_pretrained(path)
+    AutoTokenizer.from_pretrained(model_id, trust_remote_code=True).save_pretrained(path)
+    with open(os.path.join(path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"model_id": model_id, "dtype": dtype, "revision": getattr(model.config, "_commit_hash", None),
+                   "aliases": aliases, "buffers": buffers}, f,
+                  ensure_ascii=False, indent=2)
+    return path
+
+
+def _set_tensor(model, name: str, tensor: torch.Tensor, is_buffer: bool):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if is_buffer or attr in module._buffers:
+        module._buffers[attr] = tensor
+    else:
+        module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+
+
+def load_snapshot(path: str, device: str = "cpu"):
+    """
+    从快照加载模型：在 meta 设备上构建模型结构 (不分配、不初始化权重)，
+    再把 safetensors 中已是目标 dtype 的张量直接挂到模型上 (CPU 上为内存映射，不做 dtype 转换)。
+    """
+    with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    config = AutoConfig.from_pretrained(path)
+    with torch.device("meta"), no_init_weights():
+        model = AutoModelForCausalLM.from_config(config, dtype=getattr(torch, meta["dtype"]))
+
+    buffers = set(meta["buffers"])
+    loaded: Dict[str, torch.Tensor] = {}
+    with safe_open(os.path.join(path, WEIGHTS_FILE), framework="pt", device=str(device)) as f:
+        for name in f.keys():
+            loaded[name] = f.get_tensor(name)
+    for name, target in meta["aliases"].items():
+        loaded[name] = loaded[target]
+    for name, tensor in loaded.items():
+        _set_tensor(model, name, tensor, name in buffers)
+
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise RuntimeError(f"快照 {path} 缺少张量: {missing[:5]}")
+    if os.path.exists(os.path.join(path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    return model.eval()
+
+
+def snapshot_is_current(path: str, model_id: str) -> bool:
+    """
+    快照存在且与本地 HF 缓存中模型当前的 revision 一致。只读本地文件，不访问网络；
+    无法得知当前 revision (本地目录、缓存中没有该模型) 时沿用已有快照。
+    """
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        return False
+    with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    revision = local_revision(model_id)
+    if revision is not None and meta.get("revision") != revision:
+        print(f"快照 {path} 的 revision ({meta.get('revision')}) 与本地缓存中模型的 revision ({revision}) 不一致")
+        return False
+    return True
+
+
+def load_cached_model(model_id: str,
+                      dtype: str = "bfloat16",
+                      device_map: str = "cuda:0",
+                      cache_dir: str = CACHE_DIR,
+                      timings: Optional[Dict[str, float]] = None,
+                      refresh: bool = False):
+    """
+    通过本地快照加载模型，快照不存在、本地缓存中模型的 revision 已变化或 refresh 为 True 时先 (重新) 构建。
+    device_map 为单个设备时走快照的快速路径，否则 (例如 "auto") 对快照目录调用 from_pretrained，仍可省去 dtype 转换与远程代码解析。
+    传入 timings 时记录构建与加载耗时 (秒)。
+    """
+    path = snapshot_dir(model_id, dtype, cache_dir)
+    start = time.perf_counter()
+    if refresh or not snapshot_is_current(path, model_id):
+        build_snapshot(model_id, dtype, cache_dir)
+        if timings is not None:
+            timings["build_seconds"] = time.perf_counter() - start
+        start = time.perf_counter()
+
+    if device_map == "auto" or isinstance(device_map, dict):
+        model = AutoModelForCausalLM.from_pretrained(path, dtype=getattr(torch, dtype), device_map=device_map)
+    else:
+        model = load_snapshot(path, device_map)
+    seconds = time.perf_counter() - start
+    if timings is not None:
+        timings["load_seconds"] = seconds
+    print(f"从快照 {path} 加载模型耗时 {seconds:.2f} 秒")
+    return model
+
+
+def load_cached_tokenizer(model_id: str, dtype: str = "bfloat16", cache_dir: str = CACHE_DIR):
+    """快照中已缓存 tokenizer 且快照与模型当前的 revision 一致时从本地加载，否则从原始模型加载"""
+    path = snapshot_dir(model_id, dtype, cache_dir)
+    if os.path.exists(os.path.join(path, "tokenizer_config.json")) and snapshot_is_current(path, model_id):
+        return AutoTokenizer.from_pretrained(path)
+    return AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
@@ -1,14 +1,44 @@
 import os
+import time
 import yaml
 import json
+import asyncio
+import httpx
 from typing import List, Dict, Optional, Any
-from openai import OpenAI, OpenAIError
+from openai import OpenAI, AsyncOpenAI, OpenAIError, APIStatusError
+from batch_ledger import BatchLedger, TERMINAL_STATUSES, file_digest
+
+
+class TokenBucket:
+    """异步令牌桶限流：rate 为每秒补充的令牌数，capacity 为允许的突发量"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1.0):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
 
 
 class OpenAIHandler:
     def __init__(self):
+        # 旧版的 batch_id 记录文件，仅在台账为空时作为回退读取
         self.batch_id_record_path = "data/batch_id_record.txt"
+        self.ledger = BatchLedger("data/batch_ledger.sqlite3")
         api_key = None
+        base_url = None
 
         if os.path.exists("config.yml"):
             try:
@@ -17,14 +47,19 @@ class OpenAIHandler:
                     if config:
                         # 尝试读取 openai_api_key 或 openai.api_key
                         api_key = config.get("openai_api_key")
+                        # 可选: 指向兼容 OpenAI 的服务 (例如本地 stub server)
+                        base_url = config.get("openai_base_url")
             except Exception as e:
                 print(f"读取 config.yml 失败: {e}")
 
         if not api_key:
             raise ValueError("未在 config.yml 中找到有效的 API Key")
 
+        self.api_key = api_key
+        self.base_url = base_url
         self.client = OpenAI(
             api_key=api_key,
+            base_url=base_url,
         )
 
     def create_batch_input_file(self,
@@ -73,40 +108,82 @@ class OpenAIHandler:
                 completion_window="24h"
             )
 
-            # 持久化 batch_id 到本地文件
-            with open(self.batch_id_record_path, "a", encoding="utf-8") as f:
-                f.write(f"{batch_response.id}\n")
+            # 持久化 batch_id 及其输入文件 (路径与内容摘要)、custom_id 范围到台账
+            with open(jsonl_file_path, "r", encoding="utf-8") as f:
+                custom_ids = [json.loads(line)["custom_id"]
+                              for line in f if line.strip()]
+            self.ledger.record_submission(
+                batch_id=batch_response.id,
+                input_file=jsonl_file_path,
+                first_item_id=custom_ids[0] if custom_ids else None,
+                last_item_id=custom_ids[-1] if custom_ids else None,
+                num_items=len(custom_ids),
+                status=batch_response.status,
+                input_hash=file_digest(jsonl_file_path)
+            )
 
             return batch_response.id
         except OpenAIError as e:
             print(f"OpenAI API 请求错误: {e}")
             return None
 
-    def check_batch_status(self, batch_id: Optional[str] = None) -> Any:
-        """查询 Batch 任务状态"""
-        if not batch_id and os.path.exists(self.batch_id_record_path):
-            with open(self.batch_id_record_path, "r", encoding="utf-8") as f:
-                batch_id = f.read().strip()
+    def check_batch_status(self, batch_id: Optional[str] = None, input_file: Optional[str] = None) -> Any:
+        """查询 Batch 任务状态；未指定 batch_id 时查询 input_file (或任意输入文件) 最近一次提交的 Batch"""
+        if not batch_id:
+            batch_id = self.latest_batch_id(input_file)
 
         if not batch_id:
             print("未指定 Batch ID 且本地未找到记录")
             return None
 
         try:
-            return self.client.batches.retrieve(batch_id)
+            batch = self.client.batches.retrieve(batch_id)
         except Exception as e:
             print(f"查询状态失败: {e}")
             return None
+        self.ledger.update_status(
+            batch_id, batch.status, batch.output_file_id, batch.error_file_id)
+        return batch
 
-    def retrieve_batch_results(self, output_file_path: str, batch_id: Optional[str] = None) -> Optional[str]:
-        """下载 Batch 结果并保存到文件"""
-        if not batch_id and os.path.exists(self.batch_id_record_path):
+    def latest_batch_id(self, input_file: Optional[str] = None) -> Optional[str]:
+        """
+        最近一次提交的 batch_id：优先读台账，台账为空时回退到旧记录文件的最后一行。
+        指定 input_file 时只查找该输入文件提交的 Batch (不会取到其他阶段或 _retry 的 Batch)。
+        """
+        if input_file:
+            record = self.ledger.find_latest_batch(input_file)
+            batch_id = record["batch_id"] if record else None
+        else:
+            batch_id = self.ledger.latest_batch_id()
+        if not batch_id and not self.ledger.list_batches() and os.path.exists(self.batch_id_record_path):
             with open(self.batch_id_record_path, "r", encoding="utf-8") as f:
-                batch_id = f.read().strip()
+                lines = [line.strip() for line in f if line.strip()]
+            batch_id = lines[-1] if lines else None
+        return batch_id
+
+    def list_batch_jobs(self, refresh: bool = True) -> List[Dict[str, Any]]:
+        """一次性列出台账中的所有 Batch；refresh 时先向 API 刷新所有未完成 Batch 的状态"""
+        if refresh:
+            for record in self.ledger.in_flight_batches():
+                self.check_batch_status(record["batch_id"])
+        return self.ledger.list_batches()
+
+    def retrieve_batch_results(self,
+                               output_file_path: str,
+                               batch_id: Optional[str] = None,
+                               input_file: Optional[str] = None) -> Optional[str]:
+        """
+        下载 Batch 结果并保存到文件。需要指定 batch_id 或 input_file (取该输入文件最近一次提交的 Batch)，
+        不会回退到台账中任意最新的 Batch (可能是其他阶段或 _retry 的 Batch)。
+        """
+        if not batch_id and not input_file:
+            raise ValueError("retrieve_batch_results 需要指定 batch_id 或 input_file")
+        if not batch_id:
+            batch_id = self.latest_batch_id(input_file)
 
         try:
             if not batch_id:
-                raise ValueError("未提供 Batch ID 且本地无记录")
+                raise ValueError(f"台账中没有输入文件 {input_file} 的 Batch 记录")
 
             batch = self.client.batches.retrieve(batch_id)
             if not batch.output_file_id:
@@ -114,46 +191,244 @@ class OpenAIHandler:
                     f"Batch 任务 {batch_id} 尚未生成 output_file_id (状态: {batch.status})")
                 return None
 
-            content = self.client.files.content(batch.output_file_id).text
-
-            # 逐行解析 JSON 并使用 ensure_ascii=False 重新序列化，以修复中文转义问题
-            decoded_lines = []
-            for line in content.splitlines():
-                if line.strip():
-                    decoded_lines.append(json.dumps(
-                        json.loads(line), ensure_ascii=False))
-            final_content = "\n".join(decoded_lines)
-
-            with open(output_file_path, "w", encoding="utf-8") as f:
-                f.write(final_content)
-            return final_content
+            results = self._download_file_lines(batch.output_file_id)
+            return self._save_retrieved_results(output_file_path, [batch_id], results)
         except Exception as e:
             print(f"下载结果失败: {e}")
             return None
 
-    def retrieve_batch_batch_results(self, output_file_path: str, batch_id_file_path: str) -> Optional[str]:
-        """下载 Batch 结果并保存到文件"""
-        with open(batch_id_file_path, "r", encoding="utf-8") as f:
-            completed_batch_id_list = [
-                json.loads(line)['batch_id'] for line in f]
+    def retrieve_batch_batch_results(self, output_file_path: str, completed_batch_id_list: List[str]) -> Optional[str]:
+        """依次下载多个 Batch 的结果并合并保存到同一个文件"""
         try:
-            with open(output_file_path, "w", encoding="utf-8") as f:
-                for batch_id in completed_batch_id_list:
-                    batch = self.client.batches.retrieve(batch_id)
-                    if not batch.output_file_id:
-                        print(
-                            f"Batch 任务 {batch_id} 尚未生成 output_file_id (状态: {batch.status})")
-                        return None
-                    content = self.client.files.content(
-                        batch.output_file_id).text
-                    decoded_lines = []
-                    for line in content.splitlines():
-                        if line.strip():
-                            decoded_lines.append(json.dumps(
-                                json.loads(line), ensure_ascii=False))
-                    if decoded_lines:
-                        final_content = "\n".join(decoded_lines)
-                        f.write(final_content + "\n")
+            results = []
+            for batch_id in completed_batch_id_list:
+                batch = self.client.batches.retrieve(batch_id)
+                if not batch.output_file_id:
+                    print(
+                        f"Batch 任务 {batch_id} 尚未生成 output_file_id (状态: {batch.status})")
+                    return None
+                results.extend(self._download_file_lines(batch.output_file_id))
+            return self._save_retrieved_results(output_file_path, completed_batch_id_list, results)
         except Exception as e:
             print(f"下载结果失败: {e}")
             return None
+
+    def _save_retrieved_results(self,
+                                output_file_path: str,
+                                batch_ids: List[str],
+                                results: List[Dict[str, Any]]) -> str:
+        """
+        保存下载的 Batch 结果。旁路文件 <output_file_path>.batches 记录结果来自哪些 Batch：
+        重复下载同一批 Batch 时保留输出文件中已成功的记录 (包括 recover_failed_requests 恢复的结果)，
+        只用下载的结果补上其余记录，重复运行不会覆盖已恢复的结果；来源不同时整体覆盖。
+        """
+        source_path = f"{output_file_path}.batches"
+        same_source = False
+        if os.path.exists(output_file_path) and os.path.exists(source_path):
+            with open(source_path, "r", encoding="utf-8") as f:
+                same_source = json.load(f) == list(batch_ids)
+        if same_source:
+            # 恢复的请求可能只出现在错误文件中 (不在下载的输出文件里)，同样保留
+            succeeded = {}
+            with open(output_file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        if not self.is_failed_result(result):
+                            succeeded[str(result["custom_id"])] = result
+            downloaded = {str(result["custom_id"]) for result in results}
+            results = [succeeded.get(str(result["custom_id"]), result) for result in results] + \
+                [result for custom_id, result in succeeded.items() if custom_id not in downloaded]
+
+        # 使用 ensure_ascii=False 重新序列化，以修复中文转义问题
+        final_content = "\n".join(json.dumps(result, ensure_ascii=False) for result in results)
+        with open(output_file_path, "w", encoding="utf-8") as f:
+            if final_content:
+                f.write(final_content + "\n")
+        with open(source_path, "w", encoding="utf-8") as f:
+            json.dump(list(batch_ids), f)
+        return final_content
+
+    def _download_file_lines(self, file_id: Optional[str]) -> List[Dict[str, Any]]:
+        """下载 Batch 输出/错误文件并逐行解析为字典"""
+        if not file_id:
+            return []
+        content = self.client.files.content(file_id).text
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    @staticmethod
+    def is_failed_result(result: Dict[str, Any]) -> bool:
+        """判断一条 Batch 结果是否失败 (请求级错误、非 200 状态码或 body 中含 error)"""
+        if result.get("error") is not None:
+            return True
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            return True
+        body = response.get("body") or {}
+        return body.get("error") is not None
+
+    def get_failed_results(self, batch_id: str) -> Dict[str, Any]:
+        """读取 Batch 的错误文件与输出文件，返回 {custom_id: error} 形式的失败记录"""
+        batch = self.client.batches.retrieve(batch_id)
+        failed = {}
+        for result in self._download_file_lines(batch.error_file_id) + \
+                self._download_file_lines(batch.output_file_id):
+            if self.is_failed_result(result):
+                response = result.get("response") or {}
+                body = response.get("body") or {}
+                failed[str(result.get("custom_id"))] = result.get(
+                    "error") or body.get("error") or response.get("status_code")
+        return failed
+
+    def wait_for_batch(self, batch_id: str, poll_interval: int = 30) -> Any:
+        """轮询直到 Batch 进入终止状态，返回最终的 Batch 对象"""
+        while True:
+            batch = self.check_batch_status(batch_id)
+            if batch and batch.status in TERMINAL_STATUSES:
+                return batch
+            print(
+                f"Batch {batch_id} 运行中 (状态: {batch.status if batch else 'Unknown'})...")
+            time.sleep(poll_interval)
+
+    def recover_failed_requests(self,
+                                batch_input_file: str,
+                                batch_id: str,
+                                output_file_path: str,
+                                max_retries: int = 3,
+                                base_delay: int = 30,
+                                poll_interval: int = 30,
+                                manifest_path: Optional[str] = None) -> Dict[str, Any]:
+        """
+        只重新提交 Batch 中失败的请求，并把恢复的结果合并进 output_file_path。
+
+        - 失败的 custom_id 来自错误文件以及输出文件中状态码非 200 的记录
+        - 每轮重试前按 base_delay * 2^attempt 指数退避，最多重试 max_retries 轮
+        - 仍然失败的请求写入失败清单 (默认 <output_file_path>.failed.jsonl)，并作为返回值
+        """
+        if manifest_path is None:
+            manifest_path = f"{output_file_path}.failed.jsonl"
+
+        with open(batch_input_file, "r", encoding="utf-8") as f:
+            requests_by_id = {}
+            for line in f:
+                if line.strip():
+                    request = json.loads(line)
+                    requests_by_id[str(request["custom_id"])] = request
+
+        failed = self.get_failed_results(batch_id)
+        # 已在 output_file_path 中成功的请求 (之前运行恢复的结果) 不再重新提交
+        if os.path.exists(output_file_path):
+            with open(output_file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        if not self.is_failed_result(result):
+                            failed.pop(str(result["custom_id"]), None)
+        retry_input_file = f"{os.path.splitext(batch_input_file)[0]}_retry.jsonl"
+
+        for attempt in range(max_retries):
+            if not failed:
+                break
+            delay = base_delay * (2 ** attempt)
+            print(f"第 {attempt + 1} 轮重试: {len(failed)} 个失败请求, {delay} 秒后重新提交...")
+            time.sleep(delay)
+
+            with open(retry_input_file, "w", encoding="utf-8") as f:
+                for custom_id in failed:
+                    if custom_id in requests_by_id:
+                        f.write(json.dumps(
+                            requests_by_id[custom_id], ensure_ascii=False) + "\n")
+
+            retry_batch_id = self.submit_batch_job(retry_input_file)
+            if not retry_batch_id:
+                continue
+            retry_batch = self.wait_for_batch(retry_batch_id, poll_interval)
+
+            recovered = [result for result in self._download_file_lines(retry_batch.output_file_id)
+                         if not self.is_failed_result(result)]
+            self.merge_batch_results(output_file_path, recovered)
+            for result in recovered:
+                failed.pop(str(result["custom_id"]), None)
+            print(f"第 {attempt + 1} 轮重试恢复 {len(recovered)} 个请求")
+
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            for custom_id, error in failed.items():
+                f.write(json.dumps(
+                    {"custom_id": custom_id, "error": error}, ensure_ascii=False, default=str) + "\n")
+        if failed:
+            print(f"仍有 {len(failed)} 个请求失败, 清单已写入 {manifest_path}")
+        return failed
+
+    @classmethod
+    def merge_batch_results(cls, output_file_path: str, recovered: List[Dict[str, Any]]):
+        """按 custom_id 用恢复的结果替换 output_file_path 中的失败记录 (不存在则追加)"""
+        results = {}
+        if os.path.exists(output_file_path):
+            with open(output_file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        results[str(result["custom_id"])] = result
+        for result in recovered:
+            results[str(result["custom_id"])] = result
+
+        with open(output_file_path, "w", encoding="utf-8") as f:
+            for result in results.values():
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    def run_realtime_jobs(self,
+                          jsonl_file_path: str,
+                          output_file_path: str,
+                          concurrency: int = 16,
+                          requests_per_minute: float = 500) -> List[Dict[str, Any]]:
+        """
+        实时模式：直接并发调用 /v1/responses 执行 Batch 输入文件中的请求，不经过 24h 的 Batch 窗口。
+
+        输入是 create_batch_input_file 生成的同一个 JSONL 文件；输出与 Batch 结果文件的格式一致
+        (custom_id, response.status_code, response.body.output, error)，下游解析脚本无需修改。
+        """
+        with open(jsonl_file_path, "r", encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+
+        results = asyncio.run(self._run_realtime_requests(
+            requests, concurrency, requests_per_minute))
+
+        with open(output_file_path, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        return results
+
+    async def _run_realtime_requests(self,
+                                     requests: List[Dict[str, Any]],
+                                     concurrency: int,
+                                     requests_per_minute: float) -> List[Dict[str, Any]]:
+        semaphore = asyncio.Semaphore(concurrency)
+        # 突发量至少为 1 个令牌，否则 requests_per_minute < 12 时 acquire 永远拿不到令牌
+        bucket = TokenBucket(rate=requests_per_minute / 60,
+                             capacity=max(1.0, min(concurrency, requests_per_minute / 60 * 5)))
+        # 连接池大小与并发数一致，复用 keep-alive 连接
+        http_client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=concurrency, max_keepalive_connections=concurrency))
+
+        async with AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client) as client:
+            async def run_one(index: int, request: Dict[str, Any]) -> Dict[str, Any]:
+                async with semaphore:
+                    await bucket.acquire()
+                    result = {"id": f"realtime_req_{index}",
+                              "custom_id": request["custom_id"],
+                              "response": None,
+                              "error": None}
+                    try:
+                        response = await client.responses.create(**request["body"])
+                        result["response"] = {"status_code": 200,
+                                              "request_id": getattr(response, "_request_id", None),
+                                              "body": response.model_dump(mode="json")}
+                    except APIStatusError as e:
+                        result["response"] = {"status_code": e.status_code,
+                                              "request_id": e.request_id,
+                                              "body": {"error": e.body}}
+                    except Exception as e:
+                        result["error"] = {"code": type(e).__name__, "message": str(e)}
+                    return result
+
+            return await asyncio.gather(*(run_one(i, request) for i, request in enumerate(requests)))
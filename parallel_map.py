@@ -0,0 +1,98 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+
+class ItemError:
+    """单条记录处理失败时在结果流中的占位对象，不会中止整个运行"""
+
+    def __init__(self, index: int, error: str, trace: str = ""):
+        self.index = index
+        self.error = error
+        self.trace = trace
+
+    def __repr__(self):
+        return f"ItemError(index={self.index}, error={self.error!r})"
+
+
+def _run_chunk(func: Callable, start: int, chunk: List[Any]) -> List[Any]:
+    results = []
+    for offset, item in enumerate(chunk):
+        try:
+            results.append(func(item))
+        except (Exception, SystemExit) as e:
+            # SystemExit 也按单条失败处理 (部分旧脚本在无效输入时直接 exit)
+            results.append(ItemError(start + offset, f"{type(e).__name__}: {e}", traceback.format_exc()))
+    return results
+
+
+def ordered_parallel_map(func: Callable,
+                         items: Iterable[Any],
+                         workers: Optional[int] = None,
+                         chunksize: int = 64,
+                         max_pending_chunks: Optional[int] = None) -> Iterator[Any]:
+    """
+    把 items 按 chunksize 分块交给进程池执行 func，并按输入顺序逐条产出结果。
+
+    - 先完成的块暂存在重排缓冲区中，直到前面的块都已产出
+    - 同时提交的块数不超过 max_pending_chunks (默认 workers * 4)，输入可以是惰性的迭代器
+    - 单条记录抛出的异常以 ItemError 的形式出现在对应位置
+    - workers <= 1 时在当前进程中顺序执行，便于调试
+    func 与 items 需要可以被 pickle (func 须为模块顶层函数)。
+    """
+    workers = workers or os.cpu_count() or 1
+    iterator = iter(items)
+
+    if workers <= 1:
+        start = 0
+        while True:
+            chunk = list(islice(iterator, chunksize))
+            if not chunk:
+                return
+            yield from _run_chunk(func, start, chunk)
+            start += len(chunk)
+
+    max_pending_chunks = max_pending_chunks or workers * 4
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}        # future -> 块序号
+        starts = {}         # 块序号 -> 起始下标
+        sizes = {}          # 块序号 -> 块大小
+        buffer = {}         # 重排缓冲区：块序号 -> 结果
+        next_chunk = 0      # 下一个要提交的块
+        next_output = 0     # 下一个要产出的块
+        next_start = 0
+        exhausted = False
+
+        while True:
+            while not exhausted and len(pending) + len(buffer) < max_pending_chunks:
+                chunk = list(islice(iterator, chunksize))
+                if not chunk:
+                    exhausted = True
+                    break
+                future = executor.submit(_run_chunk, func, next_start, chunk)
+                pending[future] = next_chunk
+                starts[next_chunk] = next_start
+                sizes[next_chunk] = len(chunk)
+                next_start += len(chunk)
+                next_chunk += 1
+
+            if not pending and not buffer:
+                return
+
+            if pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    try:
+                        buffer[index] = future.result()
+                    except Exception as e:
+                        # 整个块失败 (例如结果无法 pickle、工作进程崩溃)，块内每条记为失败
+                        buffer[index] = [ItemError(starts[index] + offset, f"{type(e).__name__}: {e}")
+                                         for offset in range(sizes[index])]
+
+            while next_output in buffer:
+                yield from buffer.pop(next_output)
+                del starts[next_output], sizes[next_output]
+                next_output += 1
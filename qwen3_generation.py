@@ -0,0 +1,333 @@
+import time
+import torch
+from typing import Dict, List, Optional, Any
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+from model_cache import load_cached_model, load_cached_tokenizer
+
+MODEL_ID = "Qwen/Qwen3-8b"
+# 通过本地快照 (预先转换为目标 dtype 的 safetensors + 缓存的 config/tokenizer) 加载模型，跳过 dtype 转换与远程代码解析。
+# 首次启用时会在 data/model_cache 下写入与模型同等大小的快照 (Qwen3-8B bf16 约 16 GB)，默认关闭
+USE_MODEL_CACHE = False
+MODEL_CACHE_DTYPE = "bfloat16"
+
+# Qwen3 thinking 模式推荐的采样参数
+SAMPLING_KWARGS = {
+    "temperature": 0.6,
+    "top_p": 0.95,
+    "top_k": 20,
+    "min_p": 0
+}
+
+
+# KV cache 策略：
+# - dynamic: transformers 默认的动态 cache
+# - quantized: 量化 KV cache (int4 使用 optimum-quanto, int8 使用 hqq，需另行安装对应依赖)
+# - offloaded: 只在设备上保留正在计算的层，其余层的 KV 卸载到 CPU 内存
+KV_CACHE_MODES = ("dynamic", "quantized", "offloaded")
+
+
+def load_model(model_id: str = MODEL_ID, device_map: str = "cuda:0", use_cache: bool = USE_MODEL_CACHE):
+    """use_cache 为 True 时通过本地快照加载 (首次运行时构建快照，见 model_cache)"""
+    if use_cache:
+        return load_cached_model(model_id, MODEL_CACHE_DTYPE, device_map)
+    return AutoModelForCausalLM.from_pretrained(
+        model_id,
+        device_map=device_map,
+        dtype="auto",
+        trust_remote_code=True
+    )
+
+
+def load_tokenizer(model_id: str = MODEL_ID, use_cache: bool = USE_MODEL_CACHE):
+    if use_cache:
+        return load_cached_tokenizer(model_id, MODEL_CACHE_DTYPE)
+    return AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
+
+
+class ForwardCounter:
+    """通过 forward pre-hook 统计模型 forward 的调用次数"""
+
+    def __init__(self, model):
+        self.calls = 0
+        self.handle = model.register_forward_pre_hook(self._hook)
+
+    def _hook(self, module, args):
+        self.calls += 1
+
+    def remove(self):
+        self.handle.remove()
+
+
+class AssistedGenerationStats:
+    """
+    累计一次运行中的生成统计。
+
+    辅助生成 (assisted generation) 中，draft 模型每次 forward 提出一个候选 token，
+    目标模型每次 forward 验证一轮候选并额外产出一个 token，因此：
+    - 接受的 draft token 数 = 新 token 数 - 目标模型 forward 次数
+    - 接受率 = 接受的 draft token 数 / draft 模型 forward 次数
+    """
+
+    def __init__(self):
+        self.new_tokens = 0
+        self.target_forwards = 0
+        self.draft_forwards = 0
+        self.seconds = 0.0
+
+    def update(self, new_tokens: int, target_forwards: int, draft_forwards: int, seconds: float):
+        self.new_tokens += new_tokens
+        self.target_forwards += target_forwards
+        self.draft_forwards += draft_forwards
+        self.seconds += seconds
+
+    def summary(self) -> Dict[str, Any]:
+        accepted = max(self.new_tokens - self.target_forwards, 0)
+        return {
+            "new_tokens": self.new_tokens,
+            "target_forwards": self.target_forwards,
+            "draft_forwards": self.draft_forwards,
+            "acceptance_rate": accepted / self.draft_forwards if self.draft_forwards else None,
+            "tokens_per_target_forward": self.new_tokens / self.target_forwards if self.target_forwards else None,
+            "tokens_per_second": self.new_tokens / self.seconds if self.seconds else None,
+        }
+
+
+def load_assistant_model(draft_model_id: str, model, num_assistant_tokens: int = 5):
+    """
+    加载与目标模型共享 tokenizer 的小 draft 模型 (例如 Qwen/Qwen3-0.6B)，并固定每轮的 draft 长度。
+    """
+    if USE_MODEL_CACHE:
+        assistant_model = load_cached_model(draft_model_id, str(model.dtype).replace("torch.", ""), str(model.device))
+    else:
+        assistant_model = AutoModelForCausalLM.from_pretrained(
+            draft_model_id,
+            device_map=model.device,
+            dtype=model.dtype,
+            trust_remote_code=True
+        )
+    configure_assistant_model(assistant_model, num_assistant_tokens)
+    return assistant_model
+
+
+def configure_assistant_model(assistant_model, num_assistant_tokens: int = 5):
+    assistant_model.generation_config.num_assistant_tokens = num_assistant_tokens
+    assistant_model.generation_config.num_assistant_tokens_schedule = "constant"
+    # 关闭按 draft 置信度提前停止，使每轮 draft 长度固定为 num_assistant_tokens
+    assistant_model.generation_config.assistant_confidence_threshold = 0
+
+
+def generate(model,
+             tokenizer,
+             input_ids: torch.Tensor,
+             attention_mask: Optional[torch.Tensor] = None,
+             max_new_tokens: int = 38912,
+             assistant_model=None,
+             stats: Optional[AssistedGenerationStats] = None,
+             **generate_kwargs) -> torch.Tensor:
+    """
+    对 model.generate 的统一封装，默认使用 SAMPLING_KWARGS。
+
+    传入 assistant_model 时启用辅助 (speculative) 解码：draft 模型提出候选，目标模型一次 forward 验证。
+    采样模式下 transformers 使用 speculative sampling 的接受/拒绝规则，输出分布与不使用 draft 时一致。
+    传入 stats 时累计新 token 数、forward 次数与耗时。
+    """
+    kwargs = {**SAMPLING_KWARGS, "do_sample": True, **generate_kwargs}
+    if assistant_model is not None:
+        kwargs["assistant_model"] = assistant_model
+
+    target_counter = ForwardCounter(model) if stats is not None else None
+    draft_counter = ForwardCounter(assistant_model) if stats is not None and assistant_model is not None else None
+    start = time.perf_counter()
+    try:
+        with torch.no_grad():
+            generated_ids = model.generate(
+                input_ids,
+                max_new_tokens=max_new_tokens,
+                attention_mask=attention_mask,
+                pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+                **kwargs
+            )
+    finally:
+        if target_counter is not None:
+            target_counter.remove()
+        if draft_counter is not None:
+            draft_counter.remove()
+
+    if stats is not None:
+        new_ids = generated_ids[:, input_ids.shape[1]:]
+        if tokenizer.pad_token_id is not None and tokenizer.pad_token_id != tokenizer.eos_token_id:
+            # 批量生成时提前结束的序列会被 pad 补齐，不计入新 token
+            new_tokens = int((new_ids != tokenizer.pad_token_id).sum())
+        else:
+            new_tokens = new_ids.numel()
+        stats.update(
+            new_tokens=new_tokens,
+            target_forwards=target_counter.calls,
+            draft_forwards=draft_counter.calls if draft_counter is not None else 0,
+            seconds=time.perf_counter() - start
+        )
+    return generated_ids
+
+
+def cache_generate_kwargs(mode: str = "dynamic", nbits: int = 4) -> Dict[str, Any]:
+    """把 KV cache 策略转换为 model.generate 的参数"""
+    if mode == "dynamic":
+        return {}
+    if mode == "quantized":
+        backend = "quanto" if nbits in (2, 4) else "HQQ"
+        return {"cache_implementation": "quantized",
+                "cache_config": {"backend": backend, "nbits": nbits}}
+    if mode == "offloaded":
+        return {"cache_implementation": "offloaded"}
+    raise ValueError(f"未知的 KV cache 策略: {mode} (可选: {KV_CACHE_MODES})")
+
+
+def kv_bytes_per_token(config, mode: str = "dynamic", nbits: int = 4, dtype_bytes: int = 2) -> float:
+    """
+    估算每个 token 在设备上占用的 KV cache 字节数。
+
+    quantized 按 nbits 计 (忽略保留的少量未量化残差 token)；offloaded 只计设备上同时驻留的两层。
+    """
+    text_config = config.get_text_config() if hasattr(config, "get_text_config") else config
+    head_dim = getattr(text_config, "head_dim", None) or \
+        text_config.hidden_size // text_config.num_attention_heads
+    num_kv_heads = getattr(text_config, "num_key_value_heads", None) or text_config.num_attention_heads
+    layers = text_config.num_hidden_layers
+    bytes_per_value = dtype_bytes
+    if mode == "quantized":
+        bytes_per_value = nbits / 8
+    elif mode == "offloaded":
+        layers = min(layers, 2)
+    return 2 * layers * num_kv_heads * head_dim * bytes_per_value
+
+
+def plan_memory_batches(prompt_lengths: List[int],
+                        config,
+                        memory_budget_bytes: Optional[float],
+                        max_new_tokens: int,
+                        mode: str = "dynamic",
+                        nbits: int = 4,
+                        max_batch_size: int = 64,
+                        num_samples: int = 1) -> List[List[int]]:
+    """
+    按显存预算把样本 (按输入顺序) 切成批次：一批的 KV 占用按
+    批大小 x 每个输入的采样数 x (本批最长输入 + max_new_tokens) x 每 token 字节数 估算，不超过预算。
+    未设置预算时每批一个样本。
+    """
+    if not memory_budget_bytes:
+        return [[i] for i in range(len(prompt_lengths))]
+    per_token = kv_bytes_per_token(config, mode, nbits)
+    batches = []
+    current = []
+    longest = 0
+    for i, length in enumerate(prompt_lengths):
+        new_longest = max(longest, length)
+        cost = (len(current) + 1) * num_samples * (new_longest + max_new_tokens) * per_token
+        if current and (cost > memory_budget_bytes or len(current) >= max_batch_size):
+            batches.append(current)
+            current, new_longest = [], length
+        current.append(i)
+        longest = new_longest
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _left_pad(model, tokenizer, prompt_ids: List[List[int]]):
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    longest = max(len(ids) for ids in prompt_ids)
+    input_ids = torch.tensor(
+        [[pad_token_id] * (longest - len(ids)) + list(ids) for ids in prompt_ids], device=model.device)
+    attention_mask = torch.tensor(
+        [[0] * (longest - len(ids)) + [1] * len(ids) for ids in prompt_ids], device=model.device)
+    return input_ids, attention_mask
+
+
+def _strip_padding(tokenizer, prompt_ids: List[List[int]], generated_ids: torch.Tensor) -> List[List[int]]:
+    """去掉左侧 padding 以及提前结束的序列末尾补齐的 pad"""
+    longest = max(len(ids) for ids in prompt_ids)
+    sequences = []
+    for ids, row in zip(prompt_ids, generated_ids.tolist()):
+        row = row[longest - len(ids):]
+        if len(prompt_ids) > 1 and tokenizer.pad_token_id is not None and tokenizer.pad_token_id != tokenizer.eos_token_id:
+            while len(row) > len(ids) and row[-1] == tokenizer.pad_token_id:
+                row.pop()
+        sequences.append(row)
+    return sequences
+
+
+def generate_batch(model,
+                   tokenizer,
+                   prompt_ids: List[List[int]],
+                   max_new_tokens: int = 38912,
+                   assistant_model=None,
+                   stats: Optional[AssistedGenerationStats] = None,
+                   **generate_kwargs) -> List[List[int]]:
+    """
+    对一批已分词的输入做左侧 padding 后生成，返回每个样本去掉 padding 的完整序列 (输入 + 输出)。
+    批大小为 1 时与逐条调用 generate 完全一致。
+    """
+    input_ids, attention_mask = _left_pad(model, tokenizer, prompt_ids)
+    generated_ids = generate(model, tokenizer, input_ids, attention_mask, max_new_tokens,
+                             assistant_model=assistant_model, stats=stats, **generate_kwargs)
+    return _strip_padding(tokenizer, prompt_ids, generated_ids)
+
+
+def generate_samples(model,
+                     tokenizer,
+                     prompt_ids: List[List[int]],
+                     num_samples: int,
+                     max_new_tokens: int = 38912,
+                     assistant_model=None,
+                     stats: Optional[AssistedGenerationStats] = None,
+                     cache_mode: str = "dynamic",
+                     cache_nbits: int = 4,
+                     **generate_kwargs) -> List[List[List[int]]]:
+    """
+    对每个输入采样 num_samples 条续写，返回 [输入][样本] -> 完整序列 (输入 + 输出)。
+
+    每批输入只 prefill 一次 (除最后一个 token)，再把 KV cache 按样本数复制后从同一前缀并行采样，
+    避免 num_samples 次重复的 prefill；采样结果与逐条独立生成同分布。
+    - quantized cache 不支持复制，退化为 num_return_sequences (prefill 在复制后的批上进行)
+    - 辅助解码只支持批大小 1，退化为对每个输入逐个样本生成
+    """
+    if num_samples == 1:
+        sequences = generate_batch(model, tokenizer, prompt_ids, max_new_tokens, assistant_model, stats,
+                                   **cache_generate_kwargs(cache_mode, cache_nbits), **generate_kwargs)
+        return [[sequence] for sequence in sequences]
+
+    if assistant_model is not None:
+        return [[generate_batch(model, tokenizer, [ids], max_new_tokens, assistant_model, stats,
+                                **cache_generate_kwargs(cache_mode, cache_nbits), **generate_kwargs)[0]
+                 for _ in range(num_samples)]
+                for ids in prompt_ids]
+
+    input_ids, attention_mask = _left_pad(model, tokenizer, prompt_ids)
+    expanded_prompts = [ids for ids in prompt_ids for _ in range(num_samples)]
+    if cache_mode == "quantized" or input_ids.shape[1] < 2:
+        generated_ids = generate(model, tokenizer, input_ids, attention_mask, max_new_tokens,
+                                 stats=stats, num_return_sequences=num_samples,
+                                 **cache_generate_kwargs(cache_mode, cache_nbits), **generate_kwargs)
+    else:
+        if cache_mode not in ("dynamic", "offloaded"):
+            raise ValueError(f"未知的 KV cache 策略: {cache_mode} (可选: {KV_CACHE_MODES})")
+        # 共享 prefill：最后一个输入 token 留给 generate，使其从已有的 cache 继续
+        start = time.perf_counter()
+        cache = DynamicCache(config=model.config, offloading=cache_mode == "offloaded")
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        with torch.no_grad():
+            model(input_ids=input_ids[:, :-1],
+                  attention_mask=attention_mask[:, :-1],
+                  position_ids=position_ids[:, :-1],
+                  past_key_values=cache,
+                  use_cache=True)
+        cache.batch_repeat_interleave(num_samples)
+        if stats is not None:
+            stats.update(new_tokens=0, target_forwards=1, draft_forwards=0, seconds=time.perf_counter() - start)
+        generated_ids = generate(model, tokenizer,
+                                 input_ids.repeat_interleave(num_samples, dim=0),
+                                 attention_mask.repeat_interleave(num_samples, dim=0),
+                                 max_new_tokens, stats=stats, past_key_values=cache, **generate_kwargs)
+
+    sequences = _strip_padding(tokenizer, expanded_prompts, generated_ids)
+    return [sequences[i * num_samples:(i + 1) * num_samples] for i in range(len(prompt_ids))]
@@ -1,11 +1,35 @@
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import os
 import json
 from tqdm import tqdm
 from datasets import load_dataset, Dataset
 import textwrap
+from qwen3_generation import (MODEL_ID, load_model, load_tokenizer, load_assistant_model,
+                              generate_samples, AssistedGenerationStats, plan_memory_batches)
+from length_scheduler import (load_prior_lengths, plan_schedule, schedule_report, arrival_assign,
+                              shard_path, merge_results_by_id)
 
 OUTPUT_FILE = "qwen3_logiqa_results.jsonl"
+# 辅助 (speculative) 解码：设置为与 Qwen3 共享 tokenizer 的小模型 (例如 "Qwen/Qwen3-0.6B") 以启用
+DRAFT_MODEL_ID = None
+NUM_ASSISTANT_TOKENS = 5
+# KV cache 策略 ("dynamic" / "quantized" / "offloaded")，quantized 时 KV_CACHE_NBITS 可选 4 或 8
+KV_CACHE_MODE = "dynamic"
+KV_CACHE_NBITS = 4
+# KV cache 显存预算 (GB)，设置后按预算自动组批；None 表示逐条生成。辅助解码只支持逐条生成
+KV_MEMORY_BUDGET_GB = None
+MAX_NEW_TOKENS = 38912
+# 每个输入的采样数：大于 1 时每个输入只 prefill 一次，复制 KV cache 后并行采样，结果以 sample_idx 区分
+NUM_SAMPLES = 1
+# 输出长度感知调度：用之前一次运行的结果 PRIOR_RESULTS_FILE 预测输出长度，相近长度的样本同批、最长的先执行，
+# 结束后按 id 顺序重写输出文件 (中途中断时输出为调度顺序，可用 `python length_scheduler.py OUTPUT_FILE OUTPUT_FILE` 恢复)。
+# 只在按显存预算组批或分片运行时生效，逐条生成且单进程时调度没有收益。
+# PRIOR_RESULTS_FILE 为之前输出的副本，不能是 OUTPUT_FILE 本身 (本次运行会覆盖它)
+LENGTH_SCHEDULING = False
+PRIOR_RESULTS_FILE = "data/qwen3_logiqa_prior_results.jsonl"
+# 多进程 (例如每张 GPU 一个进程) 分片运行：各进程设置相同的 NUM_SHARDS 与不同的 SHARD_INDEX，
+# 输出写入 OUTPUT_FILE 的 .shard<i> 分片，全部完成后用 `python length_scheduler.py OUTPUT_FILE 分片...` 合并
+NUM_SHARDS = 1
+SHARD_INDEX = 0
 
 
 def load_LogiQA():
@@ -51,66 +75,102 @@ def format_prompt(item):
 
 
 def generate_with_qwen3():
-    MODEL_ID = "Qwen/Qwen3-8b"
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_ID,
-        device_map="cuda:0",
-        dtype="auto",
-        trust_remote_code=True
-    )
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, trust_remote_code=True)
+    model = load_model(MODEL_ID)
+    tokenizer = load_tokenizer(MODEL_ID)
+    assistant_model = None
+    if DRAFT_MODEL_ID:
+        assistant_model = load_assistant_model(
+            DRAFT_MODEL_ID, model, NUM_ASSISTANT_TOKENS)
+    stats = AssistedGenerationStats()
     dataset = load_LogiQA()
     # 显式断言类型以消除 IDE 关于 len() 的类型警告
     assert isinstance(dataset, Dataset)
 
+    # 1. 获取格式化后的消息列表和正确答案，并应用 Chat Template 分词
+    # Chat Template 会将 messages 列表转换为模型原生的字符串格式 (例如包含 <|im_start|> 等 tag)
+    prompt_ids = []
+    correct_labels = []
+    for item in dataset:
+        messages, correct_label = format_prompt(item)
+        text = tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        prompt_ids.append(tokenizer(text).input_ids)
+        correct_labels.append(correct_label)
+
+    # 2. 按 KV cache 显存预算组批，并按预测的输出长度调度
+    memory_budget = KV_MEMORY_BUDGET_GB * (1 << 30) if KV_MEMORY_BUDGET_GB and not assistant_model else None
+
+    def plan_batches(lengths):
+        return plan_memory_batches(lengths, model.config, memory_budget, MAX_NEW_TOKENS,
+                                   KV_CACHE_MODE, KV_CACHE_NBITS, num_samples=NUM_SAMPLES)
+
+    prompt_lengths = [len(ids) for ids in prompt_ids]
+    output_file = shard_path(OUTPUT_FILE, SHARD_INDEX, NUM_SHARDS)
+    length_scheduling = LENGTH_SCHEDULING and (memory_budget is not None or NUM_SHARDS > 1)
+    if length_scheduling and os.path.abspath(PRIOR_RESULTS_FILE) == os.path.abspath(output_file):
+        raise ValueError(f"PRIOR_RESULTS_FILE 不能是本次的输出文件 {output_file}，请指向之前输出的副本")
+    if length_scheduling:
+        predicted_report = {}
+        batches = plan_schedule(list(range(len(prompt_ids))), prompt_lengths, load_prior_lengths(PRIOR_RESULTS_FILE),
+                                MAX_NEW_TOKENS, plan_batches, NUM_SHARDS, SHARD_INDEX, predicted_report)
+        print("按预测长度调度:", json.dumps(predicted_report, ensure_ascii=False, indent=2))
+    else:
+        batches = plan_batches(prompt_lengths)
+        batches = [batches[b] for b in arrival_assign(len(batches), NUM_SHARDS)[SHARD_INDEX]]
+    # 每个样本实际的输出 token 数 (多个采样时取最长)
+    actual_lengths = [0] * len(prompt_ids)
+
     # Use 'w' to overwrite or 'a' to append. Open once for efficiency.
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        # 遍历所有数据
-        for i, item in enumerate(tqdm(dataset, total=len(dataset), desc="推理进度")):
-            # 1. 获取格式化后的消息列表和正确答案
-            messages, correct_label = format_prompt(item)
-
-            # 2. 应用 Chat Template
-            # 这会将 messages 列表转换为模型原生的字符串格式 (例如包含 <|im_start|> 等 tag)
-            text = tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )
-
-            # 3. 转换为 Tensor 并移动到模型所在的设备
-            model_inputs = tokenizer([text], return_tensors="pt").to(
-                model.device)
-
-            # 4. 模型生成
-            with torch.no_grad():
-                generated_ids = model.generate(
-                    model_inputs.input_ids,
-                    max_new_tokens=38912,
-                    attention_mask=model_inputs.attention_mask,
-                    pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
-                    temperature=0.6,
-                    top_p=0.95,
-                    top_k=20,
-                    min_p=0
+    with open(output_file, "w", encoding="utf-8") as f:
+        with tqdm(total=sum(len(batch) for batch in batches), desc="推理进度") as progress:
+            for batch in batches:
+                # 3. 模型生成
+                samples = generate_samples(
+                    model,
+                    tokenizer,
+                    [prompt_ids[i] for i in batch],
+                    NUM_SAMPLES,
+                    max_new_tokens=MAX_NEW_TOKENS,
+                    assistant_model=assistant_model,
+                    stats=stats,
+                    cache_mode=KV_CACHE_MODE,
+                    cache_nbits=KV_CACHE_NBITS
                 )
 
-            # 5. 解码输出
-            full_sequence_ids = generated_ids[0].tolist()
-            full_sequence_text = tokenizer.decode(
-                generated_ids[0], skip_special_tokens=False)
-            result_data = {
-                "id": i,
-                # [核心字段] 完整的 Token IDs，直接喂给模型 forward() 即可提取激活值，无歧义
-                "full_ids": full_sequence_ids,
-                # [辅助字段] 包含特殊字符的完整文本，用于人工检查
-                "full_text": full_sequence_text,
-                # 记录正确答案以便后续对比
-                "label": correct_label
-            }
-
-            f.write(json.dumps(result_data, ensure_ascii=False) + "\n")
-            f.flush()
+                # 4. 解码输出
+                for i, sequences in zip(batch, samples):
+                    actual_lengths[i] = max(len(ids) for ids in sequences) - prompt_lengths[i]
+                    for sample_idx, full_sequence_ids in enumerate(sequences):
+                        full_sequence_text = tokenizer.decode(
+                            full_sequence_ids, skip_special_tokens=False)
+                        result_data = {
+                            "id": i,
+                            # 同一输入的第几个采样 (NUM_SAMPLES 为 1 时恒为 0)
+                            "sample_idx": sample_idx,
+                            # [核心字段] 完整的 Token IDs，直接喂给模型 forward() 即可提取激活值，无歧义
+                            "full_ids": full_sequence_ids,
+                            # [辅助字段] 包含特殊字符的完整文本，用于人工检查
+                            "full_text": full_sequence_text,
+                            # 记录正确答案以便后续对比
+                            "label": correct_labels[i]
+                        }
+
+                        f.write(json.dumps(result_data, ensure_ascii=False) + "\n")
+                f.flush()
+                progress.update(len(batch))
+
+    # 本次运行的接受率与有效生成速度
+    print(json.dumps(stats.summary(), ensure_ascii=False, indent=2))
+
+    if length_scheduling and NUM_SHARDS == 1:
+        # 按调度顺序写入的结果恢复为 id 顺序，并报告按实际输出长度计算的调度效果
+        merge_results_by_id([output_file], output_file)
+        print("按实际长度计算:", json.dumps(
+            schedule_report(plan_batches(prompt_lengths), batches, actual_lengths, prompt_lengths, 1),
+            ensure_ascii=False, indent=2))
 
 
 if __name__ == "__main__":
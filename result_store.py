@@ -0,0 +1,173 @@
+import os
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Any, Callable, Tuple
+import zstandard
+
+INDEX_FILE = "index.jsonl"
+DEFAULT_MAX_SHARD_BYTES = 256 << 20
+
+
+def shard_path(store_dir: str, shard: int) -> str:
+    return os.path.join(store_dir, f"shard-{shard:05d}.zst")
+
+
+class ResultStoreWriter:
+    """
+    把结果记录写成 zstd 压缩的分片文件。
+
+    每条记录单独压缩为一个 zstd frame 并顺序追加到当前分片，分片压缩后超过 max_shard_bytes 时换新分片；
+    旁路索引 index.jsonl 记录每个 (id, sample_idx) 所在的 (分片, 偏移, 长度)，因此读取单条记录只需一次 seek + 解压。
+    """
+
+    def __init__(self, store_dir: str, max_shard_bytes: int = DEFAULT_MAX_SHARD_BYTES, level: int = 3):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.max_shard_bytes = max_shard_bytes
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.shard = 0
+        self.offset = 0
+        self.shard_file = open(shard_path(store_dir, self.shard), "wb")
+        self.index_file = open(os.path.join(store_dir, INDEX_FILE), "w", encoding="utf-8")
+
+    def write(self, record: Dict[str, Any]):
+        frame = self.compressor.compress(
+            json.dumps(record, ensure_ascii=False).encode("utf-8"))
+        if self.offset > 0 and self.offset + len(frame) > self.max_shard_bytes:
+            self.shard_file.close()
+            self.shard += 1
+            self.offset = 0
+            self.shard_file = open(shard_path(self.store_dir, self.shard), "wb")
+        self.shard_file.write(frame)
+        self.index_file.write(json.dumps(
+            {"id": record["id"], "sample_idx": record.get("sample_idx", 0),
+             "shard": self.shard, "offset": self.offset, "length": len(frame)}) + "\n")
+        self.offset += len(frame)
+
+    def close(self):
+        self.shard_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ResultStore:
+    """
+    按 (id, sample_idx) 随机读取、顺序流式读取或按分片并行读取 ResultStoreWriter 写出的结果。
+    NUM_SAMPLES > 1 时同一 id 有多条记录；单采样结果与旧索引没有 sample_idx，视为 0。
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.entries: List[Dict[str, Any]] = []
+        self.index: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self.sample_ids: Dict[str, List[int]] = {}
+        with open(os.path.join(store_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self.entries.append(entry)
+                key = (str(entry["id"]), entry.get("sample_idx", 0))
+                if key not in self.index:
+                    self.sample_ids.setdefault(key[0], []).append(key[1])
+                self.index[key] = entry
+        self.num_shards = max((entry["shard"] for entry in self.entries), default=-1) + 1
+        # zstd 解压对象与文件句柄不是线程安全的，每个线程各自持有一份
+        self.local = threading.local()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, record_id) -> bool:
+        """record_id 为 id (检查第一条采样) 或 (id, sample_idx)"""
+        if isinstance(record_id, tuple):
+            record_id, sample_idx = record_id
+        else:
+            sample_idx = 0
+        return (str(record_id), sample_idx) in self.index
+
+    def ids(self) -> List[Any]:
+        return [entry["id"] for entry in self.entries]
+
+    def _decompressor(self):
+        if not hasattr(self.local, "decompressor"):
+            self.local.decompressor = zstandard.ZstdDecompressor()
+            self.local.files = {}
+        return self.local.decompressor
+
+    def _read(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        decompressor = self._decompressor()
+        files = self.local.files
+        if entry["shard"] not in files:
+            files[entry["shard"]] = open(shard_path(self.store_dir, entry["shard"]), "rb")
+        f = files[entry["shard"]]
+        f.seek(entry["offset"])
+        return json.loads(decompressor.decompress(f.read(entry["length"])))
+
+    def get(self, record_id, sample_idx: int = 0) -> Optional[Dict[str, Any]]:
+        """O(1) 读取单条记录 (默认第一条采样)，不存在时返回 None"""
+        entry = self.index.get((str(record_id), sample_idx))
+        return self._read(entry) if entry is not None else None
+
+    def get_samples(self, record_id) -> List[Dict[str, Any]]:
+        """读取同一 id 的全部采样，按 sample_idx 排序"""
+        return [self._read(self.index[(str(record_id), sample_idx)])
+                for sample_idx in sorted(self.sample_ids.get(str(record_id), []))]
+
+    def iter_shard(self, shard: int) -> Iterator[Dict[str, Any]]:
+        """按写入顺序流式读取一个分片 (一次顺序读，不依赖随机 seek)"""
+        decompressor = zstandard.ZstdDecompressor()
+        entries = [entry for entry in self.entries if entry["shard"] == shard]
+        with open(shard_path(self.store_dir, shard), "rb") as f:
+            for entry in entries:
+                yield json.loads(decompressor.decompress(f.read(entry["length"])))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for shard in range(self.num_shards):
+            yield from self.iter_shard(shard)
+
+    def map_shards(self, func: Callable[[Dict[str, Any]], Any], workers: int = 4) -> List[List[Any]]:
+        """用线程池并行读取各分片 (zstd 解压会释放 GIL)，对每条记录调用 func，按分片顺序返回结果"""
+        def run(shard: int) -> List[Any]:
+            return [func(record) for record in self.iter_shard(shard)]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, range(self.num_shards)))
+
+
+def jsonl_to_store(jsonl_path: str, store_dir: str, max_shard_bytes: int = DEFAULT_MAX_SHARD_BYTES):
+    """把现有的 JSONL 结果文件转换为分片存储"""
+    with open(jsonl_path, "r", encoding="utf-8") as f, ResultStoreWriter(store_dir, max_shard_bytes) as writer:
+        for line in f:
+            if line.strip():
+                writer.write(json.loads(line))
+
+
+def store_to_jsonl(store_dir: str, jsonl_path: str):
+    """把分片存储还原为 JSONL，供仍按 JSONL 读取的脚本使用"""
+    with open(jsonl_path, "w", encoding="utf-8") as f:
+        for record in ResultStore(store_dir):
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSONL 结果文件与 zstd 分片存储之间的转换")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_store = subparsers.add_parser("to-store")
+    to_store.add_argument("jsonl_path")
+    to_store.add_argument("store_dir")
+    to_store.add_argument("--max-shard-mb", type=int, default=DEFAULT_MAX_SHARD_BYTES >> 20)
+    to_jsonl = subparsers.add_parser("to-jsonl")
+    to_jsonl.add_argument("store_dir")
+    to_jsonl.add_argument("jsonl_path")
+    args = parser.parse_args()
+
+    if args.command == "to-store":
+        jsonl_to_store(args.jsonl_path, args.store_dir, args.max_shard_mb << 20)
+    else:
+        store_to_jsonl(args.store_dir, args.jsonl_path)
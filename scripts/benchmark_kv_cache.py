@@ -0,0 +1,91 @@
+import json
+import time
+import threading
+import multiprocessing
+import psutil
+import torch
+from qwen3_generation import (load_model, load_tokenizer, generate, AssistedGenerationStats,
+                              cache_generate_kwargs, kv_bytes_per_token)
+
+# 在小模型上对比各 KV cache 策略的内存占用与生成速度，帮助为每台机器选择合适的配置
+# (offloaded 需要 CUDA 设备，在 CPU 上运行时会记录为错误)
+BENCHMARK_MODEL_ID = "Qwen/Qwen3-0.6B"
+DEVICE = "cpu"
+PROMPT_TOKENS = 512
+NEW_TOKENS = 1024
+BATCH_SIZES = [1, 4]
+CACHE_CONFIGS = [
+    {"mode": "dynamic", "nbits": 16},
+    {"mode": "quantized", "nbits": 4},
+    {"mode": "quantized", "nbits": 8},
+    {"mode": "offloaded", "nbits": 16},
+]
+OUTPUT_FILE = "data/benchmark_kv_cache.jsonl"
+
+
+class PeakMemorySampler:
+    """后台线程采样进程 RSS 的峰值 (CPU)；CUDA 上直接使用 max_memory_allocated"""
+
+    def __init__(self, interval: float = 0.01):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = self.process.memory_info().rss
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.running = False
+        self.thread.join()
+
+
+def run_one(mode: str, nbits: int, batch_size: int) -> dict:
+    """在独立进程中运行单个配置，避免前一个配置残留的内存影响峰值"""
+    result = {"mode": mode, "nbits": nbits, "batch_size": batch_size}
+    try:
+        model = load_model(BENCHMARK_MODEL_ID, device_map=DEVICE)
+        model.eval()
+        tokenizer = load_tokenizer(BENCHMARK_MODEL_ID)
+        input_ids = torch.randint(0, tokenizer.vocab_size, (batch_size, PROMPT_TOKENS), device=model.device)
+        if model.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        baseline = psutil.Process().memory_info().rss
+        stats = AssistedGenerationStats()
+        with PeakMemorySampler() as sampler:
+            generate(model, tokenizer, input_ids, torch.ones_like(input_ids), NEW_TOKENS,
+                     stats=stats, min_new_tokens=NEW_TOKENS, **cache_generate_kwargs(mode, nbits))
+        if model.device.type == "cuda":
+            result["peak_memory_mb"] = torch.cuda.max_memory_allocated() / (1 << 20)
+        else:
+            result["peak_memory_mb"] = (sampler.peak - baseline) / (1 << 20)
+        result["estimated_kv_mb"] = kv_bytes_per_token(model.config, mode, nbits) * \
+            batch_size * (PROMPT_TOKENS + NEW_TOKENS) / (1 << 20)
+        result["tokens_per_second"] = stats.summary()["tokens_per_second"]
+    except Exception as e:
+        # 缺少 optimum-quanto / hqq 等依赖时记录错误并继续其他配置
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+if __name__ == "__main__":
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for cache_config in CACHE_CONFIGS:
+        for batch_size in BATCH_SIZES:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_one, (cache_config["mode"], cache_config["nbits"], batch_size))
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
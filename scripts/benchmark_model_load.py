@@ -0,0 +1,49 @@
+import json
+import time
+import multiprocessing
+import torch
+from transformers import AutoModelForCausalLM
+from model_cache import load_cached_model, build_snapshot
+
+# 对比直接 from_pretrained 与从本地快照加载的耗时；默认用小模型在 CPU 上验证，
+# 换成 "Qwen/Qwen3-8b" 与 "cuda:0" 即可测量实际运行时的加载时间
+BENCHMARK_MODEL_ID = "Qwen/Qwen3-0.6B"
+DEVICE = "cpu"
+DTYPE = "bfloat16"
+REPEATS = 3
+OUTPUT_FILE = "data/benchmark_model_load.jsonl"
+
+
+def run_one(method: str) -> dict:
+    """在独立进程中加载一次模型，避免同一进程内的缓存影响计时"""
+    result = {"method": method, "model_id": BENCHMARK_MODEL_ID, "device": DEVICE}
+    start = time.perf_counter()
+    if method == "from_pretrained":
+        model = AutoModelForCausalLM.from_pretrained(
+            BENCHMARK_MODEL_ID, device_map=DEVICE, dtype="auto", trust_remote_code=True)
+    else:
+        model = load_cached_model(BENCHMARK_MODEL_ID, DTYPE, DEVICE)
+    # 做一次 forward，确认权重可用并把延迟的页面读取计入耗时
+    with torch.no_grad():
+        model(torch.tensor([[0]], device=model.device))
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    build_snapshot(BENCHMARK_MODEL_ID, DTYPE)
+    print(f"构建快照耗时 {time.perf_counter() - start:.2f} 秒")
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for method in ["from_pretrained", "snapshot"]:
+        for _ in range(REPEATS):
+            with context.Pool(1) as pool:
+                result = pool.apply(run_one, (method,))
+            print(json.dumps(result, ensure_ascii=False))
+            results.append(result)
+
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
@@ -2,4 +2,8 @@ from openai_api_framework import OpenAIHandler
 
 
 handler = OpenAIHandler()
-print(handler.check_batch_status())
\ No newline at end of file
+# 刷新并列出台账中的所有 Batch 任务
+for record in handler.list_batch_jobs():
+    print(f"{record['batch_id']}  {record['status']:<12} {record['input_file']}  "
+          f"items {record['first_item_id']}-{record['last_item_id']} ({record['num_items']})  "
+          f"output={record['output_file_id']} error={record['error_file_id']}  updated {record['updated_at']}")
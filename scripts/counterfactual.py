@@ -4,6 +4,9 @@ import textwrap
 from datasets import load_dataset, Dataset
 from openai_api_framework import OpenAIHandler
 
+# True 时使用实时并发模式，结果直接写入 Batch 结果文件的位置，可直接运行 process_counterfactual_result.py
+REALTIME = False
+
 
 def load_LogiQA():
     return load_dataset(
@@ -49,14 +52,31 @@ def get_prompt(context, query, options, corrupt_index):
     return instructions, input
 
 
+def request_perturbed_option(client, logiqa_item, extracted_answer, model="gpt-5-mini"):
+    """
+    单条同步调用 /v1/responses 获取扰动后的选项 (供流水线逐条构造反事实使用)，
+    返回 {"perturbed_option": ..., "explanation": ...}
+    """
+    instructions, input = get_prompt(
+        logiqa_item['context'], logiqa_item['query'], logiqa_item['options'], extracted_answer)
+    response = client.responses.create(
+        model=model, input=input, instructions=instructions)
+    text = json.loads(response.output_text)
+    return {"perturbed_option": text["perturbed_option"], "explanation": text["explanation"]}
+
+
 if __name__ == "__main__":
     dataset = load_LogiQA()
     handler = OpenAIHandler()
     data_list = []
     with open("data/qwen3_logiqa_results_answers.jsonl", "r", encoding="utf-8") as f:
         data = [json.loads(line) for line in f]
+    # NUM_SAMPLES > 1 时每个 id 有多条采样，反事实只基于第一条采样 (sample_idx == 0) 构造，custom_id 保持唯一
+    data = [result_item for result_item in data if result_item.get('sample_idx', 0) == 0]
 
-    for i, (logiqa_item, result_item) in enumerate(zip(dataset, data)):
+    for result_item in data:
+        # 按 id 取原题 (而不是按位置)，结果文件中跳过或多采样的记录不会错配
+        logiqa_item = dataset[result_item['id']]
         instructions, input = get_prompt(
             logiqa_item['context'], logiqa_item['query'], logiqa_item['options'], result_item['extracted_answer'])
         custom_id = result_item['id']
@@ -72,8 +92,14 @@ if __name__ == "__main__":
     handler.create_batch_input_file(
         data_list, batch_input_file, model="gpt-5-mini")
 
-    # 2. 提交 Batch 任务
-    batch_id = handler.submit_batch_job(batch_input_file)
-    if batch_id:
-        print(f"Batch 任务已提交, ID: {batch_id}")
-        print("请等待任务完成，然后运行 retrieve_batch_results 方法获取结果。")
+    if REALTIME:
+        # 2. 实时并发执行，输出格式与 Batch 结果一致
+        handler.run_realtime_jobs(
+            batch_input_file, "data/counterfactual_results.jsonl")
+        print("实时任务已完成，结果已写入 data/counterfactual_results.jsonl")
+    else:
+        # 2. 提交 Batch 任务
+        batch_id = handler.submit_batch_job(batch_input_file)
+        if batch_id:
+            print(f"Batch 任务已提交, ID: {batch_id}")
+            print("请等待任务完成，然后运行 retrieve_batch_results 方法获取结果。")
@@ -1,7 +1,16 @@
+import os
+import re
+import glob
 import textwrap
 import json
 import time
 from openai_api_framework import OpenAIHandler
+from batch_ledger import TERMINAL_STATUSES, file_digest
+from parallel_map import ordered_parallel_map, ItemError
+
+# 并行提取 <think> 的进程数 (None 表示使用全部 CPU 核) 与每块的记录数
+WORKERS = None
+CHUNK_SIZE = 64
 
 
 def get_prompt(reasoning_trace):
@@ -46,26 +55,31 @@ def get_prompt(reasoning_trace):
     return instructions, input
 
 
+def build_request(full_text):
+    """并行任务：从full_text中提取位于<think>和</think>之间的字符串并构造请求，标签缺失时抛出 ValueError"""
+    start_index = full_text.find("<think>")
+    end_index = full_text.find("</think>")
+    if start_index == -1 or end_index == -1 or start_index >= end_index:
+        raise ValueError("<think> tags missing or malformed")
+    reasoning_trace = full_text[start_index +
+                                len("<think>"):end_index].strip()
+    return get_prompt(reasoning_trace)
+
+
 if __name__ == "__main__":
     handler = OpenAIHandler()
     data_list = []
     with open("data/qwen3_logiqa_results_answers.jsonl", "r", encoding="utf-8") as f:
         qwen3_logiqa_results_answers = [json.loads(line) for line in f]
-    for i, item in enumerate(qwen3_logiqa_results_answers):
-        full_text = item['full_text']
-        # 从full_text中提取位于<think>和</think>之间的字符串
-        start_index = full_text.find("<think>")
-        end_index = full_text.find("</think>")
-        reasoning_trace = ""
-
-        if start_index != -1 and end_index != -1 and start_index < end_index:
-            reasoning_trace = full_text[start_index +
-                                        len("<think>"):end_index].strip()
-        else:
+    requests = ordered_parallel_map(
+        build_request, (item['full_text'] for item in qwen3_logiqa_results_answers),
+        workers=WORKERS, chunksize=CHUNK_SIZE)
+    for i, (item, request) in enumerate(zip(qwen3_logiqa_results_answers, requests)):
+        if isinstance(request, ItemError):
             print(
                 f"Error: <think> tags missing or malformed in item {item.get('id', i)}")
             break
-        instructions, input = get_prompt(reasoning_trace)
+        instructions, input = request
         data_list.append({
             "custom_id": item['id'],
             "input": input,
@@ -73,6 +87,13 @@ if __name__ == "__main__":
         })
 
     batch_size = 100
+    # 删除上一次运行遗留的多余批次输入文件，retrieve_decompose_results.py 以现有的输入文件为准
+    num_batches = (len(data_list) + batch_size - 1) // batch_size
+    for path in glob.glob("data/decompose/decompose_batch_input_*.jsonl"):
+        match = re.fullmatch(r"decompose_batch_input_(\d+)\.jsonl", os.path.basename(path))
+        if match and int(match.group(1)) >= num_batches:
+            os.remove(path)
+
     for i in range(0, len(data_list), batch_size):
         batch_data = data_list[i:i + batch_size]
         batch_index = i // batch_size
@@ -83,10 +104,27 @@ if __name__ == "__main__":
             model="gpt-4o-mini",
             temperature=0.2
         )
+        # 根据台账判断该批次是否已完成或仍在运行，重启后继续轮询而不是重新提交。
+        # 输入文件每次运行都会重写，只有内容摘要与 custom_id 范围都一致的 Batch 才视为同一批次
+        record = handler.ledger.find_latest_batch(batch_input_file, file_digest(batch_input_file))
+        if record and (record['first_item_id'], record['last_item_id']) != \
+                (str(batch_data[0]['custom_id']), str(batch_data[-1]['custom_id'])):
+            record = None
+        if record and record['status'] == 'completed':
+            print(f"批次 {batch_index} 已在台账中标记为完成 ({record['batch_id']})，跳过...")
+            continue
+        resume_batch_id = None
+        if record and record['status'] not in TERMINAL_STATUSES:
+            resume_batch_id = record['batch_id']
+
         while True:
-            print(
-                f"正在提交第 {batch_index} 批次 (数据 {i} - {i + len(batch_data)})...")
-            batch_id = handler.submit_batch_job(batch_input_file)
+            if resume_batch_id:
+                print(f"继续轮询第 {batch_index} 批次 ({resume_batch_id})...")
+                batch_id, resume_batch_id = resume_batch_id, None
+            else:
+                print(
+                    f"正在提交第 {batch_index} 批次 (数据 {i} - {i + len(batch_data)})...")
+                batch_id = handler.submit_batch_job(batch_input_file)
             if not batch_id:
                 print("提交失败,30秒后重试...")
                 time.sleep(30)
@@ -96,20 +134,16 @@ if __name__ == "__main__":
                 time.sleep(30)
                 batch_status = handler.check_batch_status(batch_id)
                 if batch_status and batch_status.status == 'completed':
-                    print(f"批次 {batch_index} 已完成，准备提交下一批次...")
-                    with open("data/decompose/completed_batch_id.jsonl", "a", encoding="utf-8") as f:
-                        f.write(json.dumps(
-                            {"batch_index": batch_index, "batch_id": batch_id}) + "\n")
+                    # 部分请求失败不再中止流程，由 retrieve_decompose_results.py 只重试失败的请求
+                    failed_count = batch_status.request_counts.failed
+                    print(
+                        f"批次 {batch_index} 已完成 (失败数: {failed_count})，准备提交下一批次...")
                     break
                 elif batch_status and batch_status.status in ['failed', 'expired', 'cancelled']:
                     print(
                         f"批次 {batch_index} 异常结束 (状态: {batch_status.status}), 30秒后重试...")
                     time.sleep(30)
                     break
-                if batch_status and batch_status.request_counts.failed > 0:
-                    print(
-                        f"批次 {batch_index} 有处理失败 (失败数: {batch_status.request_counts.failed}), 程序退出...")
-                    exit(1)
                 print(
                     f"批次 {batch_index} 运行中 (状态: {batch_status.status if batch_status else 'Unknown'})...")
 
@@ -0,0 +1,134 @@
+import json
+import torch
+from typing import List, Tuple
+from tqdm import tqdm
+from qwen3_generation import MODEL_ID, load_model, load_tokenizer
+
+INPUT_FILE = "data/qwen3_logiqa_results_answers.jsonl"
+OUTPUT_FILE = "data/early_answer_probe.jsonl"
+
+# 每条 trace 在 <think> 内均匀取的截断点数量 (包含开头与结尾)
+NUM_CUT_POINTS = 20
+# 每次 forward 拼接在同一条序列中打分的截断点数量
+PROBE_BATCH_SIZE = 8
+# 在截断点之后强制结束思考并给出答案前缀，读取下一个 token 在各选项上的概率
+ANSWER_SUFFIX = "\n</think>\n\nThe correct option is"
+OPTIONS = ["A", "B", "C", "D"]
+
+
+def option_token_ids(tokenizer) -> List[int]:
+    """答案前缀之后各选项字母对应的 token (带前导空格)"""
+    return [tokenizer.encode(" " + option, add_special_tokens=False)[-1] for option in OPTIONS]
+
+
+def think_span(full_ids: List[int], tokenizer) -> Tuple[int, int]:
+    """返回 <think> 之后第一个 token 与 </think> 所在的位置；缺失时返回 (-1, -1)"""
+    think_id = tokenizer.convert_tokens_to_ids("<think>")
+    end_think_id = tokenizer.convert_tokens_to_ids("</think>")
+    if think_id not in full_ids or end_think_id not in full_ids:
+        return -1, -1
+    start = full_ids.index(think_id) + 1
+    end = full_ids.index(end_think_id, start)
+    return start, end
+
+
+def cut_positions(start: int, end: int, num_cut_points: int = NUM_CUT_POINTS) -> List[int]:
+    """在 [start, end] 内均匀分布的 token 截断位置 (截断后保留 full_ids[:cut])"""
+    if num_cut_points <= 1 or end <= start:
+        return [end]
+    return sorted({start + round((end - start) * k / (num_cut_points - 1)) for k in range(num_cut_points)})
+
+
+def packed_suffix_mask(cuts: torch.Tensor, cache_length: int, suffix_length: int, dtype) -> torch.Tensor:
+    """
+    把 len(cuts) 份答案前缀依次拼成一条序列时的 4D 加性 attention mask，形状 [1, 1, n * suffix_length, cache_length + n * suffix_length]：
+    第 k 份答案前缀只看到 cache 中截断点 cuts[k] 之前的位置，以及它自己之前 (含自身) 的答案前缀 token。
+    """
+    n = len(cuts)
+    device = cuts.device
+    owner = torch.arange(n, device=device).repeat_interleave(suffix_length)
+    offset = torch.arange(suffix_length, device=device).repeat(n)
+    prefix_visible = torch.arange(cache_length, device=device)[None, :] < cuts[owner][:, None]
+    suffix_visible = (owner[:, None] == owner[None, :]) & (offset[None, :] <= offset[:, None])
+    visible = torch.cat([prefix_visible, suffix_visible], dim=1)
+    mask = torch.zeros(visible.shape, dtype=dtype, device=device)
+    mask.masked_fill_(~visible, torch.finfo(dtype).min)
+    return mask[None, None]
+
+
+def probe_trace(model,
+                full_ids: List[int],
+                cuts: List[int],
+                suffix_ids: List[int],
+                option_ids: List[int],
+                batch_size: int = PROBE_BATCH_SIZE) -> torch.Tensor:
+    """
+    对同一条 trace 的多个截断点打分，返回 [len(cuts), len(OPTIONS)] 的选项概率 (在各选项上归一化)。
+
+    所有截断版本都是 full_ids 的前缀，因此先对最长的前缀做一次 forward 得到 KV cache，全程只保留这一份 cache：
+    每 batch_size 个截断点的答案前缀拼成一条序列接在 cache 后面做一次 forward，
+    用 4D attention mask 让每份答案前缀只看到自己截断点之前的前缀与自身，position_ids 接在各自的截断点后面；
+    forward 之后把 cache 裁剪回前缀长度，丢弃本批追加的答案前缀。
+    """
+    device = model.device
+    cuts = sorted(cuts)
+    cache_length = cuts[-1]
+    suffix_length = len(suffix_ids)
+    with torch.no_grad():
+        prefix = torch.tensor([full_ids[:cache_length]], device=device)
+        cache = model(prefix, use_cache=True, logits_to_keep=1).past_key_values
+
+        results = []
+        for i in range(0, len(cuts), batch_size):
+            batch_cuts = torch.tensor(cuts[i:i + batch_size], device=device)
+            batch = len(batch_cuts)
+            input_ids = torch.tensor([suffix_ids * batch], device=device)
+            position_ids = (batch_cuts[:, None] + torch.arange(suffix_length, device=device)[None, :]).reshape(1, -1)
+            attention_mask = packed_suffix_mask(batch_cuts, cache_length, suffix_length, model.dtype)
+            # 只取每份答案前缀最后一个 token 的 logits
+            last_positions = torch.arange(suffix_length - 1, batch * suffix_length, suffix_length, device=device)
+
+            logits = model(
+                input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                use_cache=True,
+                logits_to_keep=last_positions
+            ).logits[0]
+            cache.crop(cache_length)
+            results.append(torch.softmax(logits[:, option_ids].float(), dim=-1).cpu())
+    return torch.cat(results)
+
+
+if __name__ == "__main__":
+    model = load_model(MODEL_ID)
+    model.eval()
+    tokenizer = load_tokenizer(MODEL_ID)
+    suffix_ids = tokenizer.encode(ANSWER_SUFFIX, add_special_tokens=False)
+    option_ids = option_token_ids(tokenizer)
+
+    with open(INPUT_FILE, "r", encoding="utf-8") as f:
+        dataset = [json.loads(line) for line in f]
+
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        for item in tqdm(dataset, desc="截断探测"):
+            full_ids = item['full_ids']
+            start, end = think_span(full_ids, tokenizer)
+            if start == -1:
+                print(f"Error: <think> tags missing or malformed in item {item['id']}")
+                continue
+            cuts = cut_positions(start, end)
+            probs = probe_trace(model, full_ids, cuts, suffix_ids, option_ids)
+            for cut_index, (cut, cut_probs) in enumerate(zip(cuts, probs.tolist())):
+                f.write(json.dumps({
+                    "id": item['id'],
+                    "cut_index": cut_index,
+                    "cut_token": cut,
+                    "cut_frac": (cut - start) / (end - start) if end > start else 1.0,
+                    "probs": dict(zip(OPTIONS, cut_probs)),
+                    "answer": OPTIONS[max(range(len(OPTIONS)), key=lambda k: cut_probs[k])],
+                    "label": item['label'],
+                    "extracted_answer": item.get('extracted_answer', "")
+                }, ensure_ascii=False) + "\n")
+            f.flush()
@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import yaml
+from typing import Dict, List, Optional
+from tqdm import tqdm
+from trace_parser import (TAG_CONTINUE, TAG_REFLECTION, TAG_ALTERNATIVE, BACKTRACK_CODES,
+                          ParsedTrace, parse_decomposed_trace)
+
+INPUT_FILE = "data/qwen3_logiqa_results_answers.jsonl"
+OUTPUT_FILE = "data/decompose/output/decompose_results_local.jsonl"
+GPT_DECOMPOSE_FILE = "data/decompose/output/decompose_results.jsonl"
+AGREEMENT_FILE = "data/decompose/output/decompose_agreement.jsonl"
+# 可选的 YAML 线索词表，格式与 DEFAULT_CUE_LEXICON 相同 ({标签: [正则, ...]})
+CUE_LEXICON_FILE = "cue_lexicon.yml"
+
+# 与 decompose.py 中的分类说明对应：句首出现这些线索词时，该句开始一个 BACKTRACK step
+DEFAULT_CUE_LEXICON = {
+    TAG_REFLECTION: [
+        r"wait",
+        r"hmm",
+        r"hold on",
+        r"but wait",
+        r"actually",
+        r"let me (?:re-?)?(?:verify|check|double-check|re-?examine|re-?read|confirm|make sure)",
+        r"i (?:need|should|must) (?:to )?(?:verify|check|double-check|re-?examine|confirm|make sure)",
+        r"let me think again",
+        r"is that (?:right|correct)",
+        r"double-check",
+        r"no,",
+        r"oops",
+    ],
+    TAG_ALTERNATIVE: [
+        r"alternatively",
+        r"another (?:way|approach|possibility|angle|option)",
+        r"let'?s try (?:a )?(?:different|another)",
+        r"let me try (?:a )?(?:different|another)",
+        r"let me (?:consider|approach|look at) (?:this|it) (?:differently|from)",
+        r"on the other hand",
+        r"what if",
+        r"instead,",
+    ],
+}
+
+# 分句：句末标点后接空白，或空行分段
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+
+
+def load_cue_lexicon(path: str = CUE_LEXICON_FILE) -> Dict[str, List[str]]:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            lexicon = yaml.safe_load(f)
+        if lexicon:
+            return lexicon
+    return DEFAULT_CUE_LEXICON
+
+
+def compile_cue_lexicon(lexicon: Dict[str, List[str]]) -> List:
+    """每个标签编译为一个句首匹配的正则 (大小写不敏感)"""
+    return [(tag, re.compile(r"^\W*(?:" + "|".join(patterns) + r")(?!\w)", re.IGNORECASE))
+            for tag, patterns in lexicon.items() if patterns]
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in SENTENCE_BOUNDARY.split(text) if sentence and sentence.strip()]
+
+
+def tag_sentence(sentence: str, compiled_lexicon) -> str:
+    for tag, pattern in compiled_lexicon:
+        if pattern.match(sentence):
+            return tag
+    return TAG_CONTINUE
+
+
+def decompose_trace(reasoning_trace: str, compiled_lexicon) -> str:
+    """输出与 GPT 分解相同的格式：每个 step 一行标签，下一行为原文片段"""
+    lines = []
+    for sentence in split_sentences(reasoning_trace):
+        lines.append(tag_sentence(sentence, compiled_lexicon))
+        lines.append(sentence.strip())
+    return "\n".join(lines)
+
+
+def to_batch_result(custom_id, decomposed_trace: str) -> Dict:
+    """包装成 Batch API 结果的格式，insert_counterfactual.py 等下游脚本可直接读取"""
+    return {
+        "id": f"local_{custom_id}",
+        "custom_id": str(custom_id),
+        "response": {
+            "status_code": 200,
+            "request_id": None,
+            "body": {
+                "error": None,
+                "output": [{
+                    "type": "message",
+                    "role": "assistant",
+                    "content": [{"type": "output_text", "text": decomposed_trace}]
+                }]
+            }
+        },
+        "error": None
+    }
+
+
+def _coverage(parsed: ParsedTrace, length: int) -> List:
+    """每个 step 覆盖的区间 [start, 下一个 step 的 start)，用于逐字符比较标签"""
+    starts = [start for start in parsed.starts if start >= 0]
+    tags = list(parsed.tags[:len(starts)])
+    ends = starts[1:] + [length]
+    return list(zip(starts, ends, tags))
+
+
+def compare_parses(reference: ParsedTrace, candidate: ParsedTrace, length: int) -> Dict:
+    """
+    比较两种分解在同一 think 文本上的结果：
+    - tag_agreement / backtrack_agreement: 按字符计的标签一致率 (精确标签 / 是否为 BACKTRACK)
+    - boundary_*: BACKTRACK step 起始位置的 precision / recall
+    - cut_match: 两者的中间思维块结束位置是否一致 (即 insert_counterfactual 的截断点)
+    """
+    ref_spans, cand_spans = _coverage(reference, length), _coverage(candidate, length)
+    same_tag = same_class = covered = 0
+    i = j = 0
+    while i < len(ref_spans) and j < len(cand_spans):
+        r_start, r_end, r_tag = ref_spans[i]
+        c_start, c_end, c_tag = cand_spans[j]
+        overlap = min(r_end, c_end) - max(r_start, c_start)
+        if overlap > 0:
+            covered += overlap
+            same_tag += overlap if r_tag == c_tag else 0
+            same_class += overlap if (r_tag in BACKTRACK_CODES) == (c_tag in BACKTRACK_CODES) else 0
+        if r_end <= c_end:
+            i += 1
+        else:
+            j += 1
+
+    ref_bounds = {start for start, _, tag in ref_spans if tag in BACKTRACK_CODES}
+    cand_bounds = {start for start, _, tag in cand_spans if tag in BACKTRACK_CODES}
+    hits = len(ref_bounds & cand_bounds)
+    ref_cut = reference.middle_block_end_offset() if len(reference) else None
+    cand_cut = candidate.middle_block_end_offset() if len(candidate) else None
+    return {
+        "tag_agreement": same_tag / covered if covered else None,
+        "backtrack_agreement": same_class / covered if covered else None,
+        "boundary_precision": hits / len(cand_bounds) if cand_bounds else None,
+        "boundary_recall": hits / len(ref_bounds) if ref_bounds else None,
+        "cut_match": ref_cut is not None and ref_cut == cand_cut,
+        "cut_distance": abs(ref_cut - cand_cut) / length if ref_cut is not None and cand_cut is not None and length else None,
+    }
+
+
+def _mean(values: List[Optional[float]]) -> Optional[float]:
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def agreement_report(gpt_results_path: str, local_results: Dict[str, str], thinks: Dict[str, str]) -> Dict:
+    """与已有的 GPT 分解结果 (decompose_results.jsonl) 逐条比较，返回汇总指标并写出逐条结果"""
+    rows = []
+    with open(gpt_results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            item = json.loads(line)
+            custom_id = str(item['custom_id'])
+            if custom_id not in local_results or item['response']['body'].get('error') is not None:
+                continue
+            for out in item['response']['body']['output']:
+                if out["type"] == "message":
+                    think = thinks[custom_id]
+                    reference = parse_decomposed_trace(out["content"][0]["text"], think)
+                    candidate = parse_decomposed_trace(local_results[custom_id], think)
+                    rows.append({"custom_id": custom_id, **compare_parses(reference, candidate, len(think))})
+
+    with open(AGREEMENT_FILE, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    summary = {"n": len(rows)}
+    for key in ["tag_agreement", "backtrack_agreement", "boundary_precision", "boundary_recall", "cut_distance"]:
+        summary[key] = _mean([row[key] for row in rows])
+    summary["cut_match"] = _mean([float(row["cut_match"]) for row in rows])
+    return summary
+
+
+if __name__ == "__main__":
+    compiled_lexicon = compile_cue_lexicon(load_cue_lexicon())
+    with open(INPUT_FILE, "r", encoding="utf-8") as f:
+        qwen3_logiqa_results_answers = [json.loads(line) for line in f]
+
+    local_results = {}
+    thinks = {}
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        for i, item in enumerate(tqdm(qwen3_logiqa_results_answers, desc="本地分解")):
+            full_text = item['full_text']
+            # 与 decompose.py 相同：提取位于<think>和</think>之间的字符串
+            start_index = full_text.find("<think>")
+            end_index = full_text.find("</think>")
+            if start_index == -1 or end_index == -1 or start_index >= end_index:
+                print(f"Error: <think> tags missing or malformed in item {item.get('id', i)}")
+                continue
+            reasoning_trace = full_text[start_index + len("<think>"):end_index].strip()
+            custom_id = str(item['id'])
+            decomposed_trace = decompose_trace(reasoning_trace, compiled_lexicon)
+            local_results[custom_id] = decomposed_trace
+            thinks[custom_id] = reasoning_trace
+            f.write(json.dumps(to_batch_result(custom_id, decomposed_trace), ensure_ascii=False) + "\n")
+
+    if os.path.exists(GPT_DECOMPOSE_FILE):
+        summary = agreement_report(GPT_DECOMPOSE_FILE, local_results, thinks)
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
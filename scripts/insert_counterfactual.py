@@ -1,7 +1,20 @@
-import re
+import os
 import json
 from typing import Optional
 import textwrap
+from trace_parser import (ParsedTrace, parse_decomposed_trace, source_hash, save_parse_cache, load_parse_cache,
+                          load_parse_cache_hashes)
+from parallel_map import ordered_parallel_map, ItemError
+from batch_results_reader import read_batch_results
+from counterfactual_ids import splice_counterfactual_ids, worker_tokenizer
+
+# 可替换为 heuristic_decompose.py 生成的 decompose_results_local.jsonl，跳过 GPT 分解
+DECOMPOSE_RESULTS_FILE = "data/decompose/output/decompose_results.jsonl"
+# 解析缓存与分解结果文件一一对应
+PARSE_CACHE_FILE = os.path.splitext(DECOMPOSE_RESULTS_FILE)[0] + "_parse_cache.parquet"
+# 并行处理的进程数 (None 表示使用全部 CPU 核) 与每块的记录数
+WORKERS = None
+CHUNK_SIZE = 64
 
 
 def insert_counterfactual(decomposed_trace: str, original_text: str, corrupted_option: str) -> Optional[str]:
@@ -21,118 +34,25 @@ def insert_counterfactual(decomposed_trace: str, original_text: str, corrupted_o
        - 追加 corrupted_option。
        - 丢弃之后的内容。
     """
+    return insert_counterfactual_from_parse(
+        parse_decomposed_trace(decomposed_trace, original_text), original_text, corrupted_option)
 
-    # 定义标签
-    TAG_CONTINUE = "<continue_reasoning>"
-    TAG_REFLECTION = "<self_reflection>"
-    TAG_ALTERNATIVE = "<alternative_approach>"
-
-    BACKTRACK_TAGS = {TAG_REFLECTION, TAG_ALTERNATIVE}
-    ALL_TAGS = {TAG_CONTINUE, TAG_REFLECTION, TAG_ALTERNATIVE}
-
-    # 使用正则拆分，保留标签
-    # 模式匹配任何一个标签
-    pattern = r'(<(?:continue_reasoning|self_reflection|alternative_approach)>)'
-    parts = re.split(pattern, decomposed_trace)
-
-    # 解析步骤 (Tag, Content)
-    steps = []
 
-    # parts 的结构通常是 [pre_text, tag, content, tag, content, ...]
-    # 找到第一个标签的位置
-    start_idx = -1
-    for i, part in enumerate(parts):
-        if part in ALL_TAGS:
-            start_idx = i
-            break
-
-    if start_idx == -1:
+def insert_counterfactual_from_parse(parsed: ParsedTrace, original_text: str, corrupted_option: str) -> Optional[str]:
+    """与 insert_counterfactual 相同，但直接使用 (可能来自缓存的) 解析结果"""
+    if len(parsed) == 0:
         # 如果没有找到标签，直接返回原始内容 + corrupted_option
         return original_text + f"\n{corrupted_option}"
 
-    # 从第一个标签开始遍历
-    for i in range(start_idx, len(parts) - 1, 2):
-        tag = parts[i]
-        content = parts[i+1]
-        steps.append({"tag": tag, "content": content})
-
-    if not steps:
-        return original_text + f"\n{corrupted_option}"
-
-    # 构建思维块
-    blocks = []
-    current_block = []
-
-    for step in steps:
-        tag = step["tag"]
-        is_backtrack = tag in BACKTRACK_TAGS
-
-        if is_backtrack:
-            # 如果遇到 BACKTRACK 标签，且当前块不为空，则当前块结束
-            if current_block:
-                blocks.append(current_block)
-                current_block = []
-            # BACKTRACK 标签开始一个新的块
-            current_block.append(step)
-        else:
-            # CONTINUE 标签加入当前块
-            current_block.append(step)
-
-    # 加入最后一个块
-    if current_block:
-        blocks.append(current_block)
-
-    # 计算目标块索引
-    num_blocks = len(blocks)
-    if num_blocks == 0:
-        return corrupted_option
-
-    target_index = (num_blocks - 1) // 2
-
-    # 收集需要保留的文本内容（不含标签）
-    kept_content_parts = []
-
-    # 保留第一个标签前的内容（如果有）
-    if start_idx > 0:
-        kept_content_parts.append(parts[0])
-
-    # 保留直到目标索引的块
-    for i in range(target_index + 1):
-        block = blocks[i]
-        for step in block:
-            kept_content_parts.append(step["content"])
-
-    kept_raw_text = "".join(kept_content_parts)
-
-    # 将 kept_raw_text 映射回 original_text 以保留原始格式
-    # 提取 kept_raw_text 中的非空白字符作为匹配目标
-    target_chars = [c for c in kept_raw_text if not c.isspace()]
-
-    if not target_chars:
-        return corrupted_option
-
-    final_text_chars = []
-    match_idx = 0
-    target_len = len(target_chars)
-
-    for char in original_text:
-        if match_idx >= target_len:
-            break
-        final_text_chars.append(char)
-        if not char.isspace():
-            if char != target_chars[match_idx]:
-                return None
-            match_idx += 1
-
-    if match_idx < target_len:
+    # 中间思维块在原文中的结束位置，保留的内容直接从 original_text 切出以保留原始格式
+    cut = parsed.middle_block_end_offset()
+    if cut is None:
         return None
-
-    result_text = "".join(final_text_chars)
+    if cut == 0:
+        return corrupted_option
 
     # 插入 corrupted_option
-    result_text += f"\n\n{corrupted_option}"
-
-    return result_text
+    return original_text[:cut] + f"\n\n{corrupted_option}"
 
 
 def extract_think(original_text):
@@ -152,45 +72,93 @@ def get_corrupted_think(corrupted_option, target_index):
     return temp
 
 
+def parse_item(args):
+    """并行任务：解析一条分解结果并对齐到 full_text 的 think 部分"""
+    decomposed_trace, full_text = args
+    return parse_decomposed_trace(decomposed_trace, extract_think(full_text) or "")
+
+
+def build_counterfactual(args):
+    """
+    并行任务：根据解析结果构造一条反事实输入，返回 (反事实文本, 反事实 token ids)，文本不一致时返回 None。
+    token ids 由原始 full_ids 截断后拼接插入文本的分词结果得到，与原始运行的前缀完全一致。
+    """
+    parsed, full_text, full_ids, target_index, perturbed_option = args
+    # 提取full_text中从开头到“<think>\n”之间的部分（包含“<think>\n”）
+    prefix_text = ""
+    start_index = full_text.find("<think>\n")
+    if start_index != -1:
+        prefix_text = full_text[:start_index + len("<think>\n")]
+    think = extract_think(full_text)
+    if think is None:
+        think = ""
+    corrupted_think = get_corrupted_think(perturbed_option, target_index)
+    insert_result = insert_counterfactual_from_parse(parsed, think, corrupted_think)
+    if insert_result is None:
+        return None
+    counterfactual = prefix_text + insert_result
+    return counterfactual, splice_counterfactual_ids(worker_tokenizer(), full_ids, full_text, counterfactual)
+
+
 if __name__ == "__main__":
-    with open("data/decompose/output/decompose_results.jsonl", "r", encoding="utf-8") as f:
-        decompose_results = [json.loads(line) for line in f]
+    # 列式读取全部 Batch 结果，只保留有 message 文本的记录
+    decompose_results, rejects = read_batch_results(DECOMPOSE_RESULTS_FILE)
+    for reject in rejects.to_pylist():
+        print(f"无法解析的 Batch 结果行: {reject['reason']}")
     with open("data/perturbed_option_list.jsonl", "r", encoding="utf-8") as f:
         perturbed_option_list = [json.loads(line) for line in f]
 
-    decompose_list = []
-    for item in decompose_results:
-        custom_id = item['custom_id']
-        response = item['response']
-        body = response['body']
-        output = body['output']
-        for out in output:
-            if out["type"] == "message":
-                content = out["content"][0]
-                text = content["text"]
-                decompose_list.append(
-                    {'custom_id': custom_id, 'decomposed_trace': text})
-
-    decompose_list.sort(key=lambda x: int(x['custom_id']))
+    decompose_by_id = {
+        int(custom_id): {'custom_id': custom_id, 'decomposed_trace': text}
+        for custom_id, text in zip(decompose_results['custom_id'].to_pylist(), decompose_results['text'].to_pylist())
+        if text is not None
+    }
+    # 按 id 配对 (而不是按位置)，失败或后来恢复的记录不会错配到其他题目
+    pairs = [(decompose_by_id[item['id']], item) for item in perturbed_option_list if item['id'] in decompose_by_id]
+    missing = len(perturbed_option_list) - len(pairs)
+    if missing:
+        print(f"{missing} 条记录没有分解结果，跳过")
+
+    # 解析结果 (step 标签与偏移) 缓存为列式文件，其他插入策略与分析脚本可直接复用。
+    # 缓存按输入摘要校验：恢复流程新合并进来的记录或内容变化的记录会被重新解析
+    hashes = {str(decompose['custom_id']): source_hash(decompose['decomposed_trace'], extract_think(item['full_text']) or "")
+              for decompose, item in pairs}
+    if os.path.exists(PARSE_CACHE_FILE):
+        parse_cache = load_parse_cache(PARSE_CACHE_FILE)
+        cached_hashes = load_parse_cache_hashes(PARSE_CACHE_FILE)
+    else:
+        parse_cache, cached_hashes = {}, {}
+    stale = [(decompose, item) for decompose, item in pairs
+             if cached_hashes.get(str(decompose['custom_id'])) != hashes[str(decompose['custom_id'])]]
+    if stale:
+        print(f"解析缓存中缺少或已过期 {len(stale)} 条，重新解析")
+        parses = ordered_parallel_map(
+            parse_item,
+            ((decompose['decomposed_trace'], item['full_text']) for decompose, item in stale),
+            workers=WORKERS, chunksize=CHUNK_SIZE)
+        for (decompose, item), parsed in zip(stale, parses):
+            if isinstance(parsed, ItemError):
+                print(f"id{item['id']}解析失败: {parsed.error}")
+                parse_cache.pop(str(decompose['custom_id']), None)
+                continue
+            parse_cache[str(decompose['custom_id'])] = parsed
+        parse_cache = {custom_id: parsed for custom_id, parsed in parse_cache.items() if custom_id in hashes}
+        save_parse_cache(PARSE_CACHE_FILE, parse_cache, hashes)
+
+    pairs = [(decompose, item) for decompose, item in pairs if str(decompose['custom_id']) in parse_cache]
+    counterfactuals = ordered_parallel_map(
+        build_counterfactual,
+        ((parse_cache[str(decompose['custom_id'])], item['full_text'], item['full_ids'],
+          item['extracted_answer'], item['perturbed_option'])
+         for decompose, item in pairs),
+        workers=WORKERS, chunksize=CHUNK_SIZE)
 
     with open("data/counterfactual/qwen3_logiqa_counterfactual.jsonl", "w", encoding="utf-8") as f:
-        for i, (decompose, item) in enumerate(zip(decompose_list, perturbed_option_list)):
-            full_text = item['full_text']
-            # 提取full_text中从开头到“<think>\n”之间的部分（包含“<think>\n”）
-            prefix_text = ""
-            start_index = full_text.find("<think>\n")
-            if start_index != -1:
-                prefix_text = full_text[:start_index + len("<think>\n")]
-            think = extract_think(full_text)
-            if think is None:
-                think = ""
-            target_index = item['extracted_answer']
-            perturbed_option = item['perturbed_option']
-            corrupted_think = get_corrupted_think(perturbed_option, target_index)
-            insert_result = insert_counterfactual(
-                decompose['decomposed_trace'], think, corrupted_think)
-            if insert_result is not None:
-                item['counterfactual'] = prefix_text + insert_result
+        for (decompose, item), counterfactual in zip(pairs, counterfactuals):
+            if isinstance(counterfactual, ItemError):
+                print(f"id{item['id']}处理失败: {counterfactual.error}\n")
+            elif counterfactual is not None:
+                item['counterfactual'], item['counterfactual_ids'] = counterfactual
                 f.write(json.dumps(item, ensure_ascii=False) + "\n")
             else:
                 print(f"id{item['id']}的文本不一致\n")
@@ -3,6 +3,12 @@ import json
 from typing import Optional
 import textwrap
 from qwen3_logiqa_generate import load_LogiQA
+from parallel_map import ordered_parallel_map, ItemError
+from counterfactual_ids import splice_counterfactual_ids, worker_tokenizer
+
+# 并行处理的进程数 (None 表示使用全部 CPU 核) 与每块的记录数
+WORKERS = None
+CHUNK_SIZE = 64
 
 
 def insert_counterfactual(original_text: str, corrupted_option: str) -> str:
@@ -67,27 +73,54 @@ def get_corrupted_think(corrupted_option, target_index, origin_options):
     return temp_1+temp_2
 
 
+def build_counterfactual(item, origin_options):
+    """根据 item 的 full_text、extracted_answer 与 perturbed_option 构造完整的反事实输入"""
+    full_text = item['full_text']
+    # 提取full_text中从开头到“<think>\n”之间的部分（包含“<think>\n”）
+    prefix_text = ""
+    start_index = full_text.find("<think>\n")
+    if start_index != -1:
+        prefix_text = full_text[:start_index + len("<think>\n")]
+    think = extract_think(full_text)
+    if think is None:
+        think = ""
+    target_index = item['extracted_answer']
+    perturbed_option = item['perturbed_option']
+    corrupted_think = get_corrupted_think(
+        perturbed_option, target_index, origin_options)
+    insert_result = insert_counterfactual(
+        think, corrupted_think)
+    return prefix_text + insert_result
+
+
+def build_counterfactual_task(args):
+    """
+    并行任务：只传入构造所需的字段，返回 (反事实文本, 反事实 token ids)。
+    token ids 由原始 full_ids 截断后拼接插入文本的分词结果得到，与原始运行的前缀完全一致。
+    """
+    full_text, full_ids, extracted_answer, perturbed_option, origin_options = args
+    item = {'full_text': full_text, 'extracted_answer': extracted_answer, 'perturbed_option': perturbed_option}
+    counterfactual = build_counterfactual(item, origin_options)
+    return counterfactual, splice_counterfactual_ids(worker_tokenizer(), full_ids, full_text, counterfactual)
+
+
 if __name__ == "__main__":
     logiQA = load_LogiQA()
     with open("data/perturbed_option_list.jsonl", "r", encoding="utf-8") as f:
         perturbed_option_list = [json.loads(line) for line in f]
 
+    # 按 id 取原题 (而不是按位置)，前面阶段跳过的样本不会使后续记录错配
+    pairs = [(item, logiQA[item['id']]) for item in perturbed_option_list]
+    counterfactuals = ordered_parallel_map(
+        build_counterfactual_task,
+        ((item['full_text'], item['full_ids'], item['extracted_answer'], item['perturbed_option'], logiQA_item['options'])
+         for item, logiQA_item in pairs),
+        workers=WORKERS, chunksize=CHUNK_SIZE)
+
     with open("data/counterfactual/qwen3_logiqa_counterfactual.jsonl", "w", encoding="utf-8") as f:
-        for i, (item, logiQA_item) in enumerate(zip(perturbed_option_list, logiQA)):
-            full_text = item['full_text']
-            # 提取full_text中从开头到“<think>\n”之间的部分（包含“<think>\n”）
-            prefix_text = ""
-            start_index = full_text.find("<think>\n")
-            if start_index != -1:
-                prefix_text = full_text[:start_index + len("<think>\n")]
-            think = extract_think(full_text)
-            if think is None:
-                think = ""
-            target_index = item['extracted_answer']
-            perturbed_option = item['perturbed_option']
-            corrupted_think = get_corrupted_think(
-                perturbed_option, target_index, logiQA_item['options'])
-            insert_result = insert_counterfactual(
-                think, corrupted_think)
-            item['counterfactual'] = prefix_text + insert_result
+        for (item, logiQA_item), counterfactual in zip(pairs, counterfactuals):
+            if isinstance(counterfactual, ItemError):
+                print(f"id{item['id']}处理失败: {counterfactual.error}")
+                continue
+            item['counterfactual'], item['counterfactual_ids'] = counterfactual
             f.write(json.dumps(item, ensure_ascii=False) + "\n")
@@ -0,0 +1,207 @@
+import json
+import time
+import queue
+import threading
+from tqdm import tqdm
+from openai_api_framework import OpenAIHandler
+from qwen3_generation import MODEL_ID, load_model, load_tokenizer, generate_batch
+from qwen3_logiqa_generate import load_LogiQA, format_prompt
+from extract_answer import extract_answer
+from counterfactual import request_perturbed_option
+from insert_counterfactual_v2 import build_counterfactual
+from counterfactual_ids import splice_counterfactual_ids
+from length_scheduler import merge_results_by_id
+
+# 与逐阶段运行时相同的输出文件 (运行中按完成顺序写入，结束时按 id 重排)
+RESULTS_FILE = "data/qwen3_logiqa_results.jsonl"
+ANSWERS_FILE = "data/qwen3_logiqa_results_answers.jsonl"
+PERTURBED_FILE = "data/perturbed_option_list.jsonl"
+COUNTERFACTUAL_FILE = "data/counterfactual/qwen3_logiqa_counterfactual.jsonl"
+COUNTERFACTUAL_RESULTS_FILE = "data/counterfactual/qwen3_logiqa_counterfactual_results.jsonl"
+
+MAX_NEW_TOKENS = 38912
+# 同时处于流水线中 (已开始生成但尚未完成反事实生成) 的最大样本数，决定各队列的容量
+MAX_IN_FLIGHT = 16
+# 调用 API 构造反事实的 CPU 线程数
+CONSTRUCT_WORKERS = 4
+
+
+class PipelineWriters:
+    """
+    各阶段结果的输出文件 (多线程共享)。样本在流水线中乱序完成，运行中按完成顺序追加写入；
+    close 时把每个文件按 id 重排，使逐阶段运行的下游脚本仍按 id 顺序读取。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = {
+            "results": RESULTS_FILE,
+            "answers": ANSWERS_FILE,
+            "perturbed": PERTURBED_FILE,
+            "counterfactual": COUNTERFACTUAL_FILE,
+            "counterfactual_results": COUNTERFACTUAL_RESULTS_FILE,
+        }
+        self.files = {name: open(path, "w", encoding="utf-8") for name, path in self.paths.items()}
+
+    def write(self, name, record):
+        with self.lock:
+            self.files[name].write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.files[name].flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        for path in self.paths.values():
+            merge_results_by_id([path], path)
+
+
+class PipelineRunner:
+    """
+    单进程流水线：只加载一次 Qwen3，样本逐条流过
+    原始生成 -> 答案抽取 -> (CPU 线程) 扰动选项与反事实构造 -> 反事实生成。
+
+    模型阶段都在同一个线程中执行，并优先处理已构造好的反事实，使第一批反事实结果尽快产出；
+    调用 API 的构造阶段在 CPU 线程池中与模型阶段重叠。队列容量不小于 MAX_IN_FLIGHT，
+    且模型线程只在流水线中样本数低于 MAX_IN_FLIGHT 时才开始新样本，因此 put 不会阻塞、不会死锁。
+    """
+
+    def __init__(self, model, tokenizer, client, writers):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.client = client
+        self.writers = writers
+        self.construct_queue = queue.Queue(maxsize=MAX_IN_FLIGHT)
+        self.counterfactual_queue = queue.Queue(maxsize=MAX_IN_FLIGHT)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.dropped = 0
+        self.start_time = time.perf_counter()
+
+    def _finish(self, dropped=False):
+        with self.lock:
+            self.in_flight -= 1
+            if dropped:
+                self.dropped += 1
+            else:
+                self.completed += 1
+                if self.completed == 1:
+                    print(f"第一条反事实结果已产出 ({time.perf_counter() - self.start_time:.0f} 秒)")
+
+    def _generate(self, prompt_ids):
+        return generate_batch(self.model, self.tokenizer, [prompt_ids], max_new_tokens=MAX_NEW_TOKENS)[0]
+
+    def generate_original(self, i, logiqa_item):
+        """阶段 1 + 2：原始生成与答案抽取"""
+        messages, correct_label = format_prompt(logiqa_item)
+        text = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True)
+        full_ids = self._generate(self.tokenizer(text).input_ids)
+        item = {
+            "id": i,
+            "full_ids": full_ids,
+            "full_text": self.tokenizer.decode(full_ids, skip_special_tokens=False),
+            "label": correct_label
+        }
+        self.writers.write("results", item)
+
+        # extract_answer 不区分大小写地校验选项字母但原样返回，构造反事实只接受大写的 "A"-"D"
+        item["extracted_answer"] = extract_answer(self.model, self.tokenizer, item, i).upper()
+        self.writers.write("answers", item)
+        if item["extracted_answer"] == "":
+            # 无效答案无法确定要扰动的选项
+            self._finish(dropped=True)
+            return
+        self.construct_queue.put((item, logiqa_item))
+
+    def generate_counterfactual(self, item):
+        """阶段 4：反事实生成"""
+        full_ids = self._generate(item['counterfactual_ids'])
+        self.writers.write("counterfactual_results", {
+            "id": item['id'],
+            "full_ids": full_ids,
+            "full_text": self.tokenizer.decode(full_ids, skip_special_tokens=False),
+            "label": item['label'],
+            "origin_answer": item['extracted_answer'],
+            "perturbed_option": item['perturbed_option'],
+            "explanation": item['explanation']
+        })
+        self._finish()
+
+    def construct_worker(self):
+        """阶段 3 (CPU 线程)：请求扰动选项并构造反事实输入"""
+        while True:
+            task = self.construct_queue.get()
+            if task is None:
+                return
+            item, logiqa_item = task
+            try:
+                item.update(request_perturbed_option(self.client, logiqa_item, item['extracted_answer']))
+                self.writers.write("perturbed", item)
+                item['counterfactual'] = build_counterfactual(item, list(logiqa_item['options']))
+                item['counterfactual_ids'] = splice_counterfactual_ids(
+                    self.tokenizer, item['full_ids'], item['full_text'], item['counterfactual'])
+                self.writers.write("counterfactual", item)
+            except (Exception, SystemExit) as e:
+                # SystemExit 也按单条失败处理 (get_corrupted_think 在无效选项时直接 exit)，
+                # 否则线程静默退出、样本永远不会完成，run() 无法结束
+                print(f"id{item['id']} 反事实构造失败: {type(e).__name__}: {e}")
+                self._finish(dropped=True)
+                continue
+            self.counterfactual_queue.put(item)
+
+    def run(self, dataset):
+        workers = [threading.Thread(target=self.construct_worker, daemon=True)
+                   for _ in range(CONSTRUCT_WORKERS)]
+        for worker in workers:
+            worker.start()
+
+        source = iter(enumerate(dataset))
+        exhausted = False
+        with tqdm(total=len(dataset), desc="流水线进度") as progress:
+            while True:
+                done = self.completed + self.dropped
+                progress.update(done - progress.n)
+                try:
+                    self.generate_counterfactual(self.counterfactual_queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+
+                if not exhausted and self.in_flight < MAX_IN_FLIGHT:
+                    try:
+                        i, logiqa_item = next(source)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        with self.lock:
+                            self.in_flight += 1
+                        self.generate_original(i, logiqa_item)
+                        continue
+
+                if exhausted and self.in_flight == 0:
+                    break
+                # 等待 CPU 线程产出下一条反事实
+                try:
+                    self.generate_counterfactual(self.counterfactual_queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+            progress.update(self.completed + self.dropped - progress.n)
+
+        for _ in workers:
+            self.construct_queue.put(None)
+        for worker in workers:
+            worker.join()
+        print(f"完成 {self.completed} 条，跳过 {self.dropped} 条，"
+              f"总耗时 {time.perf_counter() - self.start_time:.0f} 秒")
+
+
+if __name__ == "__main__":
+    model = load_model(MODEL_ID)
+    tokenizer = load_tokenizer(MODEL_ID)
+    handler = OpenAIHandler()
+    writers = PipelineWriters()
+    try:
+        PipelineRunner(model, tokenizer, handler.client, writers).run(load_LogiQA())
+    finally:
+        writers.close()
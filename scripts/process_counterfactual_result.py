@@ -1,50 +1,41 @@
 import json
 import textwrap
+from batch_results_reader import read_batch_payloads
 
-HAS_ERROR = False
+if __name__ == "__main__":
+    # 一次性列式读取全部 Batch 结果并批量解析嵌入的 JSON
+    payloads, errors, rejects = read_batch_payloads(
+        "data/counterfactual_results.jsonl", ["perturbed_option", "explanation"])
 
-with open("data/counterfactual_results.jsonl", "r", encoding="utf-8") as f:
-    data_list = [json.loads(line) for line in f]
-
-perturbed_option_list = []
-
-for item in data_list:
-    custom_id = item['custom_id']
-    response = item['response']
-    body = response['body']
-    error = body['error']
-    if error is not None:
-        HAS_ERROR = True
+    for error in errors.to_pylist():
         print(textwrap.dedent(f"""
             ----------------
-            custom_id: {custom_id}
-            error: {error}
+            custom_id: {error['custom_id']}
+            error: {error['error']}
             ----------------
         """).strip())
-    else:
-        output = body['output']
-        for out in output:
-            if out["type"] == "message":
-                content = out["content"][0]
-                print(custom_id+"\n")
-                text = json.loads(content["text"])
-                perturbed_option = text["perturbed_option"]
-                explanation = text["explanation"]
-                perturbed_option_list.append(
-                    {'custom_id': custom_id, 'perturbed_option': perturbed_option, 'explanation': explanation})
+    for reject in rejects.to_pylist():
+        print(f"custom_id: {reject['custom_id']} 无法解析 ({reject['stage']}): {reject['reason']}")
+    print(f"解析成功 {payloads.num_rows} 条，请求失败 {errors.num_rows} 条，格式错误 {rejects.num_rows} 条")
 
-# 对perturbed_option_list中的字典元素按字典里的custom_id升序排序
-perturbed_option_list.sort(key=lambda x: int(x['custom_id']))
+    # 对perturbed_option_list中的字典元素按字典里的custom_id升序排序
+    perturbed_option_list = payloads.to_pylist()
+    perturbed_option_list.sort(key=lambda x: int(x['custom_id']))
 
-with open("data/qwen3_logiqa_results_answers.jsonl", "r", encoding="utf-8") as f:
-    qwen3_logiqa_results_answers = [json.loads(line) for line in f]
+    # 反事实只基于每个 id 的第一条采样 (sample_idx == 0) 构造，按 id 与扰动选项配对
+    with open("data/qwen3_logiqa_results_answers.jsonl", "r", encoding="utf-8") as f:
+        qwen3_logiqa_results_answers = {}
+        for line in f:
+            item = json.loads(line)
+            if item.get('sample_idx', 0) == 0:
+                qwen3_logiqa_results_answers[item['id']] = item
 
-with open("data/perturbed_option_list.jsonl", "w", encoding="utf-8") as f:
-    for i, (perturbed_option, item) in enumerate(zip(perturbed_option_list, qwen3_logiqa_results_answers)):
-        if int(perturbed_option['custom_id']) != item['id']:
-            print(
-                f"id不匹配:\nperturbed_option:{perturbed_option['custom_id']}\nitem:{item['id']}\n")
-            break
-        item['perturbed_option'] = perturbed_option['perturbed_option']
-        item['explanation'] = perturbed_option['explanation']
-        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+    with open("data/perturbed_option_list.jsonl", "w", encoding="utf-8") as f:
+        for perturbed_option in perturbed_option_list:
+            item = qwen3_logiqa_results_answers.get(int(perturbed_option['custom_id']))
+            if item is None:
+                print(f"custom_id: {perturbed_option['custom_id']} 在原始结果中不存在，跳过")
+                continue
+            item['perturbed_option'] = perturbed_option['perturbed_option']
+            item['explanation'] = perturbed_option['explanation']
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
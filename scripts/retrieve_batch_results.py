@@ -2,4 +2,20 @@ from openai_api_framework import OpenAIHandler
 
 
 handler = OpenAIHandler()
-handler.retrieve_batch_results("data/counterfactual_results.jsonl")
\ No newline at end of file
+batch_input_file = "data/counterfactual_batch_input.jsonl"
+output_file_path = "data/counterfactual_results.jsonl"
+# 按输入文件查找 Batch，避免取到其他阶段的 Batch 或 recover_failed_requests 提交的 _retry Batch
+batch = handler.check_batch_status(input_file=batch_input_file)
+if batch is None:
+    print(f"台账中没有 {batch_input_file} 对应的 Batch，或查询状态失败")
+    exit(1)
+if handler.retrieve_batch_results(output_file_path, batch.id) is None:
+    exit(1)
+
+# 只重新提交失败的请求，恢复的结果合并进 output_file_path
+if batch.request_counts.failed > 0:
+    handler.recover_failed_requests(
+        batch_input_file=batch_input_file,
+        batch_id=batch.id,
+        output_file_path=output_file_path
+    )
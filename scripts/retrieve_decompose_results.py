@@ -1,18 +1,42 @@
+import os
+import re
+import glob
 from openai_api_framework import OpenAIHandler
-import json
+from batch_ledger import file_digest
 
 handler = OpenAIHandler()
 output_file_path = "data/decompose/output/decompose_results.jsonl"
-batch_id_file_path = "data/decompose/completed_batch_id.jsonl"
 
+# 从台账读取每个批次输入文件对应的已完成 Batch：只接受以当前输入文件内容提交的 Batch，
+# 输入文件被新一次运行重写后，旧内容的 Batch 不会被误用
+handler.list_batch_jobs(refresh=True)
+completed_batch_list = []
+input_files = []
+for path in glob.glob("data/decompose/decompose_batch_input_*.jsonl"):
+    match = re.fullmatch(r"decompose_batch_input_(\d+)\.jsonl", os.path.basename(path))
+    if match:
+        input_files.append((int(match.group(1)), path))
+for batch_index, path in sorted(input_files):
+    record = handler.ledger.find_latest_batch(path, file_digest(path))
+    if record is None or record['status'] != 'completed':
+        print(f"批次 {batch_index} 没有以当前输入提交且已完成的 Batch "
+              f"(状态: {record['status'] if record else '未提交'})，请先运行 decompose.py")
+        continue
+    completed_batch_list.append({"batch_index": batch_index, "batch_id": record['batch_id']})
 
-with open(batch_id_file_path, "r", encoding="utf-8") as f:
-    completed_batch_id_list = [json.loads(line)['batch_id'] for line in f]
+handler.retrieve_batch_batch_results(output_file_path, [record['batch_id'] for record in completed_batch_list])
 
-for batch_id in completed_batch_id_list:
-    batch = handler.check_batch_status(batch_id)
+# 只重新提交失败的请求，恢复的结果合并进 output_file_path
+for record in completed_batch_list:
+    batch = handler.check_batch_status(record['batch_id'])
+    if batch is None:
+        print(f"批次 {record['batch_id']} 查询状态失败, 跳过失败请求的重试")
+        continue
     if batch.request_counts.failed > 0:
-        print(f"批次 {batch_id} 有处理失败 (失败数: {batch.request_counts.failed}), 程序退出")
-        exit(1)
-
-handler.retrieve_batch_batch_results(output_file_path, batch_id_file_path)
+        print(f"批次 {record['batch_id']} 有处理失败 (失败数: {batch.request_counts.failed}), 开始重试失败请求...")
+        handler.recover_failed_requests(
+            batch_input_file=f"data/decompose/decompose_batch_input_{record['batch_index']}.jsonl",
+            batch_id=record['batch_id'],
+            output_file_path=output_file_path,
+            manifest_path=f"data/decompose/output/failed_batch_{record['batch_index']}.jsonl"
+        )
@@ -0,0 +1,68 @@
+import pandas as pd
+import pyarrow as pa
+from faithfulness_metrics import read_jsonl_columns, extract_final_answer
+
+# NUM_SAMPLES > 1 时两个生成脚本的输出 (每个 id 有多条以 sample_idx 区分的记录)
+ORIGIN_RESULT_FILE = "data/qwen3_logiqa_results.jsonl"
+COUNTERFACTUAL_RESULT_FILE = "data/counterfactual/qwen3_logiqa_counterfactual_results.jsonl"
+ORIGIN_SUMMARY_FILE = "data/self_consistency_origin.csv"
+COUNTERFACTUAL_SUMMARY_FILE = "data/self_consistency_counterfactual.csv"
+
+
+def load_samples(path: str) -> pd.DataFrame:
+    """读取多采样结果并抽取每条采样的最终答案"""
+    table = read_jsonl_columns(path, {
+        "id": pa.int64(),
+        "sample_idx": pa.int64(),
+        "full_text": pa.string(),
+        "label": pa.string(),
+        "origin_answer": pa.string(),
+    }).to_pandas()
+    table["sample_idx"] = table["sample_idx"].fillna(0).astype(int)
+    table["answer"] = extract_final_answer(table["full_text"])
+    return table.drop(columns="full_text")
+
+
+def self_consistency(samples: pd.DataFrame) -> pd.DataFrame:
+    """
+    逐个 id 的自洽性汇总：
+    - majority_answer / majority_share: 有效答案中的多数答案及其在全部采样中的占比
+    - num_distinct: 不同有效答案的个数
+    - sample_accuracy / majority_correct: 单条采样的平均正确率与多数答案是否正确
+    - flip_rate: 与原始回答不同的采样占比 (仅反事实结果)
+    """
+    samples = samples.assign(
+        valid=samples["answer"].isin(["A", "B", "C", "D"]),
+        correct=samples["answer"] == samples["label"],
+    )
+    grouped = samples.groupby("id", sort=True)
+    summary = pd.DataFrame({
+        "num_samples": grouped.size(),
+        "label": grouped["label"].first(),
+        "invalid_rate": 1 - grouped["valid"].mean(),
+        "sample_accuracy": grouped["correct"].mean(),
+    })
+
+    counts = samples[samples["valid"]].groupby(["id", "answer"]).size().rename("count").reset_index()
+    counts = counts.sort_values(["id", "count", "answer"], ascending=[True, False, True])
+    majority = counts.drop_duplicates("id").set_index("id")
+    summary["majority_answer"] = majority["answer"].reindex(summary.index).fillna("")
+    summary["majority_share"] = (majority["count"].reindex(summary.index).fillna(0) / summary["num_samples"])
+    summary["num_distinct"] = counts.groupby("id").size().reindex(summary.index).fillna(0).astype(int)
+    summary["majority_correct"] = summary["majority_answer"] == summary["label"]
+
+    if samples["origin_answer"].notna().any():
+        origin = samples["origin_answer"].fillna("").str.upper()
+        summary["origin_answer"] = grouped["origin_answer"].first().str.upper()
+        summary["flip_rate"] = (samples["answer"] != origin).groupby(samples["id"]).mean()
+    return summary.reset_index()
+
+
+if __name__ == "__main__":
+    for path, summary_file in [(ORIGIN_RESULT_FILE, ORIGIN_SUMMARY_FILE),
+                               (COUNTERFACTUAL_RESULT_FILE, COUNTERFACTUAL_SUMMARY_FILE)]:
+        summary = self_consistency(load_samples(path))
+        summary.to_csv(summary_file, index=False)
+        means = summary.drop(columns=["id", "label", "majority_answer", "origin_answer"], errors="ignore").mean()
+        print(f"{path}: {len(summary)} 条")
+        print(means.to_string())
@@ -0,0 +1,47 @@
+import os
+import sys
+import sqlite3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batch_ledger import BatchLedger, file_digest
+
+
+def test_find_latest_batch_matches_input_content(tmp_path):
+    ledger = BatchLedger(str(tmp_path / "ledger.sqlite3"))
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text('{"custom_id": "0"}\n', encoding="utf-8")
+    old_hash = file_digest(str(input_file))
+    ledger.record_submission("batch_old", str(input_file), "0", "0", 1, "completed", input_hash=old_hash)
+
+    # 同一路径被新内容覆盖后，旧 Batch 不再匹配
+    input_file.write_text('{"custom_id": "1"}\n', encoding="utf-8")
+    new_hash = file_digest(str(input_file))
+    assert new_hash != old_hash
+    assert ledger.find_latest_batch(str(input_file), new_hash) is None
+    assert ledger.find_latest_batch(str(input_file), old_hash)["batch_id"] == "batch_old"
+    assert ledger.find_latest_batch(str(input_file))["batch_id"] == "batch_old"
+
+    ledger.record_submission("batch_new", str(input_file), "1", "1", 1, input_hash=new_hash)
+    assert ledger.find_latest_batch(str(input_file), new_hash)["batch_id"] == "batch_new"
+
+
+def test_adds_input_hash_column_to_old_ledger(tmp_path):
+    db_path = str(tmp_path / "ledger.sqlite3")
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE batches (
+            batch_id TEXT PRIMARY KEY, input_file TEXT NOT NULL, first_item_id TEXT, last_item_id TEXT,
+            num_items INTEGER, status TEXT NOT NULL, output_file_id TEXT, error_file_id TEXT,
+            created_at TEXT NOT NULL, updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("INSERT INTO batches VALUES ('batch_0', 'input.jsonl', '0', '9', 10, 'completed', NULL, NULL, "
+                 "'2024-01-01T00:00:00', '2024-01-01T00:00:00')")
+    conn.commit()
+    conn.close()
+
+    ledger = BatchLedger(db_path)
+    assert ledger.find_latest_batch("input.jsonl")["input_hash"] is None
+    assert ledger.find_latest_batch("input.jsonl", "abc") is None
+    ledger.record_submission("batch_1", "input.jsonl", "0", "9", 10, input_hash="abc")
+    assert ledger.find_latest_batch("input.jsonl", "abc")["batch_id"] == "batch_1"
@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batch_results_reader import parse_json_payloads
+
+FIELDS = ["perturbed_option", "explanation"]
+
+
+def test_multiline_json_is_parsed():
+    texts = ['```json\n{\n  "perturbed_option": "ok",\n  "explanation": "e\\nf"\n}\n```',
+             '{"perturbed_option": "p", "explanation": "q"}']
+    payloads, rejects = parse_json_payloads(["0", "1"], texts, FIELDS)
+    assert payloads.to_pylist() == [
+        {"custom_id": "0", "perturbed_option": "ok", "explanation": "e\nf"},
+        {"custom_id": "1", "perturbed_option": "p", "explanation": "q"},
+    ]
+    assert rejects.num_rows == 0
+
+
+def test_raw_newline_in_string_is_rejected():
+    texts = ['{"perturbed_option": "a\nb", "explanation": "x"}',
+             '{"perturbed_option": "p", "explanation": "q"}']
+    payloads, rejects = parse_json_payloads(["0", "1"], texts, FIELDS)
+    assert payloads["custom_id"].to_pylist() == ["1"]
+    assert rejects["custom_id"].to_pylist() == ["0"]
+    assert rejects["raw"].to_pylist() == [texts[0]]
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from openai_api_framework import OpenAIHandler
+
+
+def batch_result(custom_id, status_code=200):
+    body = {"output": [{"type": "message", "content": [{"type": "output_text", "text": custom_id}]}]} \
+        if status_code == 200 else {"error": {"message": "server error"}}
+    return {"custom_id": custom_id, "error": None, "response": {"status_code": status_code, "body": body}}
+
+
+class FakeClient:
+    """只实现下载结果所需的 batches.retrieve 与 files.content；提交新 Batch 时报错"""
+
+    def __init__(self, output_lines):
+        self.output = "\n".join(json.dumps(line) for line in output_lines)
+        self.batches = SimpleNamespace(retrieve=self.retrieve, create=self.fail)
+        self.files = SimpleNamespace(content=self.content, create=self.fail)
+
+    def retrieve(self, batch_id):
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id="file-out", error_file_id=None,
+                               request_counts=SimpleNamespace(failed=1))
+
+    def content(self, file_id):
+        return SimpleNamespace(text=self.output)
+
+    def fail(self, **kwargs):
+        raise AssertionError("不应重新提交已恢复的请求")
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.yml").write_text("openai_api_key: test\n", encoding="utf-8")
+    handler = OpenAIHandler()
+    handler.client = FakeClient([batch_result("0"), batch_result("1", 500)])
+    return handler
+
+
+def read_results(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return {result["custom_id"]: result for result in map(json.loads, f)}
+
+
+def test_rerun_keeps_recovered_results(handler):
+    handler.retrieve_batch_results("output.jsonl", "batch_a")
+    assert OpenAIHandler.is_failed_result(read_results("output.jsonl")["1"])
+
+    # 模拟 recover_failed_requests 恢复了失败的请求
+    handler.merge_batch_results("output.jsonl", [batch_result("1")])
+    handler.retrieve_batch_results("output.jsonl", "batch_a")
+    results = read_results("output.jsonl")
+    assert not OpenAIHandler.is_failed_result(results["1"])
+    assert list(results) == ["0", "1"]
+
+    with open("input.jsonl", "w", encoding="utf-8") as f:
+        for custom_id in ["0", "1"]:
+            f.write(json.dumps({"custom_id": custom_id, "body": {}}) + "\n")
+    assert handler.recover_failed_requests("input.jsonl", "batch_a", "output.jsonl", base_delay=0) == {}
+
+
+def test_results_from_another_batch_are_replaced(handler):
+    handler.merge_batch_results("output.jsonl", [batch_result("1")])
+    handler.retrieve_batch_results("output.jsonl", "batch_b")
+    assert OpenAIHandler.is_failed_result(read_results("output.jsonl")["1"])
@@ -0,0 +1,51 @@
+import os
+import sys
+import random
+
+import pytest
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from counterfactual_ids import token_prefix, _decoded_token_prefix, common_prefix_length, splice_counterfactual_ids
+
+SPECIAL_TOKENS = ["<think>", "</think>", "<|im_end|>"]
+WORDS = ["Let", " me", " check", " option", " A.", "选项", "正确", "。", "🙂", " wait", "\n\n", " the", "é", "答案是", " B"]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """在随机文本上训练的小型 byte-level BPE tokenizer (与 Qwen3 同类)"""
+    rng = random.Random(0)
+    corpus = ["".join(rng.choice(WORDS) for _ in range(200)) for _ in range(300)]
+    model = Tokenizer(models.BPE())
+    model.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    model.decoder = decoders.ByteLevel()
+    model.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=400, initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), special_tokens=SPECIAL_TOKENS))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=model)
+    tokenizer.add_special_tokens({"additional_special_tokens": SPECIAL_TOKENS})
+    return tokenizer
+
+
+def test_token_prefix_matches_decoding(tokenizer):
+    rng = random.Random(1)
+    for _ in range(300):
+        text = "<think>" + "".join(rng.choice(WORDS) for _ in range(rng.randint(0, 60))) + "</think>"
+        ids = tokenizer(text, add_special_tokens=False).input_ids
+        full_text = tokenizer.decode(ids, skip_special_tokens=False)
+        for max_chars in [0, 1, rng.randint(0, len(full_text)), len(full_text)]:
+            assert token_prefix(tokenizer, ids, full_text, max_chars) == \
+                _decoded_token_prefix(tokenizer, ids, full_text, max_chars)
+
+        counterfactual = full_text[:rng.randint(0, len(full_text))] + "But I'm not sure. 选项"
+        spliced = splice_counterfactual_ids(tokenizer, ids, full_text, counterfactual)
+        assert tokenizer.decode(spliced, skip_special_tokens=False) == counterfactual
+
+
+def test_common_prefix_length():
+    rng = random.Random(2)
+    for _ in range(2000):
+        a = "".join(rng.choice("ab选") for _ in range(rng.randint(0, 20)))
+        b = "".join(rng.choice("ab选") for _ in range(rng.randint(0, 20)))
+        assert common_prefix_length(a, b) == len(os.path.commonprefix([a, b]))
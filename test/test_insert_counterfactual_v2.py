@@ -1,8 +1,9 @@
 import json
 
+# 只读取第一条记录，避免加载整个结果文件
 with open("data/counterfactual/qwen3_logiqa_counterfactual.jsonl", "r", encoding="utf-8") as f:
-    data_list = [json.loads(line) for line in f]
+    first_item = json.loads(f.readline())
 
 with open("test/test.txt", "w", encoding="utf-8") as f:
-    output = data_list[0]['counterfactual']
+    output = first_item['counterfactual']
     f.write(output)
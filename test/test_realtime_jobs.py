@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from openai_api_framework import OpenAIHandler
+
+
+class StubResponsesHandler(BaseHTTPRequestHandler):
+    """最小的 /v1/responses stub：input 为 "bad" 时返回 400，其余返回一条 message"""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path != "/v1/responses":
+            self._send(404, {"error": {"message": "not found"}})
+        elif body["input"] == "bad":
+            self._send(400, {"error": {"message": "bad input", "type": "invalid_request_error"}})
+        else:
+            self._send(200, {
+                "id": "resp_stub",
+                "object": "response",
+                "created_at": 0,
+                "model": body["model"],
+                "status": "completed",
+                "output": [
+                    {"type": "reasoning", "id": "rs_stub", "summary": []},
+                    {"type": "message", "id": "msg_stub", "role": "assistant", "status": "completed",
+                     "content": [{"type": "output_text", "text": f"echo: {body['input']}", "annotations": []}]},
+                ],
+            })
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubResponsesHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "config.yml").write_text(
+        f"openai_api_key: test\nopenai_base_url: http://127.0.0.1:{server.server_port}/v1\n", encoding="utf-8")
+    yield OpenAIHandler()
+    server.shutdown()
+
+
+def write_requests(path, inputs):
+    with open(path, "w", encoding="utf-8") as f:
+        for i, text in enumerate(inputs):
+            f.write(json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/responses",
+                                "body": {"model": "gpt-5-mini", "input": text}}) + "\n")
+
+
+def test_run_realtime_jobs_writes_batch_envelopes(handler):
+    write_requests("input.jsonl", ["a", "bad", "c"])
+    handler.run_realtime_jobs("input.jsonl", "output.jsonl", concurrency=2, requests_per_minute=6000)
+
+    with open("output.jsonl", "r", encoding="utf-8") as f:
+        results = [json.loads(line) for line in f]
+    assert [result["custom_id"] for result in results] == ["0", "1", "2"]
+
+    ok = results[0]
+    assert ok["error"] is None
+    assert ok["response"]["status_code"] == 200
+    messages = [out for out in ok["response"]["body"]["output"] if out["type"] == "message"]
+    assert messages[0]["content"][0]["text"] == "echo: a"
+
+    failed = results[1]
+    assert failed["response"]["status_code"] == 400
+    assert failed["response"]["body"]["error"]["message"] == "bad input"
+    assert OpenAIHandler.is_failed_result(failed)
+    assert not OpenAIHandler.is_failed_result(ok)
+
+
+def test_run_realtime_jobs_low_rate_limit(handler):
+    # requests_per_minute < 12 时令牌桶容量曾小于 1，acquire 永远不会返回
+    write_requests("input.jsonl", ["a"])
+    results = handler.run_realtime_jobs("input.jsonl", "output.jsonl", concurrency=4, requests_per_minute=6)
+    assert results[0]["response"]["status_code"] == 200
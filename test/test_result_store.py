@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from result_store import ResultStore, ResultStoreWriter, INDEX_FILE
+
+
+def test_index_keeps_every_sample(tmp_path):
+    store_dir = str(tmp_path / "store")
+    records = [{"id": i, "sample_idx": k, "full_text": f"{i}-{k}"} for i in range(5) for k in range(3)]
+    with ResultStoreWriter(store_dir, max_shard_bytes=64) as writer:
+        for record in records:
+            writer.write(record)
+
+    store = ResultStore(store_dir)
+    assert len(store) == len(records)
+    assert store.get(2)["full_text"] == "2-0"
+    assert store.get(2, sample_idx=1)["full_text"] == "2-1"
+    assert [record["sample_idx"] for record in store.get_samples(2)] == [0, 1, 2]
+    assert (2, 2) in store and (2, 3) not in store and 2 in store
+    assert list(store) == records
+
+
+def test_reads_index_without_sample_idx(tmp_path):
+    store_dir = str(tmp_path / "store")
+    with ResultStoreWriter(store_dir) as writer:
+        for i in range(3):
+            writer.write({"id": i, "full_text": str(i)})
+    # 旧版本写出的索引没有 sample_idx
+    index_path = os.path.join(store_dir, INDEX_FILE)
+    with open(index_path, "r", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    with open(index_path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            entry.pop("sample_idx")
+            f.write(json.dumps(entry) + "\n")
+
+    store = ResultStore(store_dir)
+    assert store.get(1)["full_text"] == "1"
+    assert store.get_samples(1) == [{"id": 1, "full_text": "1"}]
@@ -0,0 +1,118 @@
+import os
+import re
+import sys
+import random
+from typing import Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+from trace_parser import (parse_decomposed_trace, source_hash, save_parse_cache, load_parse_cache,
+                          load_parse_cache_hashes)
+from insert_counterfactual import insert_counterfactual
+
+
+def reference_insert_counterfactual(decomposed_trace: str, original_text: str, corrupted_option: str) -> Optional[str]:
+    """改写为 trace_parser 之前基于 re.split 的实现，作为等价性检查的参照"""
+    BACKTRACK_TAGS = {"<self_reflection>", "<alternative_approach>"}
+    ALL_TAGS = {"<continue_reasoning>", "<self_reflection>", "<alternative_approach>"}
+    parts = re.split(r'(<(?:continue_reasoning|self_reflection|alternative_approach)>)', decomposed_trace)
+
+    start_idx = -1
+    for i, part in enumerate(parts):
+        if part in ALL_TAGS:
+            start_idx = i
+            break
+    if start_idx == -1:
+        return original_text + f"\n{corrupted_option}"
+
+    steps = [{"tag": parts[i], "content": parts[i + 1]} for i in range(start_idx, len(parts) - 1, 2)]
+    if not steps:
+        return original_text + f"\n{corrupted_option}"
+
+    blocks = []
+    current_block = []
+    for step in steps:
+        if step["tag"] in BACKTRACK_TAGS and current_block:
+            blocks.append(current_block)
+            current_block = []
+        current_block.append(step)
+    if current_block:
+        blocks.append(current_block)
+
+    target_index = (len(blocks) - 1) // 2
+    kept_content_parts = []
+    if start_idx > 0:
+        kept_content_parts.append(parts[0])
+    for block in blocks[:target_index + 1]:
+        for step in block:
+            kept_content_parts.append(step["content"])
+
+    target_chars = [c for c in "".join(kept_content_parts) if not c.isspace()]
+    if not target_chars:
+        return corrupted_option
+
+    final_text_chars = []
+    match_idx = 0
+    for char in original_text:
+        if match_idx >= len(target_chars):
+            break
+        final_text_chars.append(char)
+        if not char.isspace():
+            if char != target_chars[match_idx]:
+                return None
+            match_idx += 1
+    if match_idx < len(target_chars):
+        return None
+    return "".join(final_text_chars) + f"\n\n{corrupted_option}"
+
+
+WORDS = ["Let", "me", "check", "option", "A.", "B", "so", "the", "answer", "is", "C,", "wait", "选项", "正确。", "x"]
+TAGS = ["<continue_reasoning>", "<self_reflection>", "<alternative_approach>"]
+SPACES = [" ", "\n", "\n\n", "  ", ""]
+
+
+def random_case(rng: random.Random):
+    """随机生成 think 原文与对应的分解结果 (包含改动空白、前缀文本、缺失内容与不一致文本)"""
+    steps = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 6))) for _ in range(rng.randint(0, 8))]
+    prefix = " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 2))) if rng.random() < 0.3 else ""
+    think = rng.choice(SPACES).join([prefix] + steps) if prefix else "\n\n".join(steps)
+
+    decomposed = prefix + rng.choice(SPACES)
+    for step in steps:
+        content = step.replace(" ", rng.choice(SPACES)) if rng.random() < 0.5 else step
+        if rng.random() < 0.05:
+            content += " extra"
+        decomposed += rng.choice(TAGS) + rng.choice(SPACES) + content + rng.choice(SPACES)
+    if rng.random() < 0.05:
+        decomposed = decomposed[:rng.randint(0, len(decomposed))]
+    return decomposed, think
+
+
+def test_matches_reference_implementation():
+    rng = random.Random(0)
+    mismatches = []
+    for _ in range(20000):
+        decomposed, think = random_case(rng)
+        expected = reference_insert_counterfactual(decomposed, think, "COUNTERFACTUAL")
+        actual = insert_counterfactual(decomposed, think, "COUNTERFACTUAL")
+        if expected != actual:
+            mismatches.append((decomposed, think, expected, actual))
+    assert not mismatches, mismatches[:3]
+
+
+def test_parse_cache_round_trip(tmp_path):
+    rng = random.Random(1)
+    cases = {str(i): random_case(rng) for i in range(50)}
+    parses = {custom_id: parse_decomposed_trace(decomposed, think) for custom_id, (decomposed, think) in cases.items()}
+    hashes = {custom_id: source_hash(decomposed, think) for custom_id, (decomposed, think) in cases.items()}
+    path = str(tmp_path / "parse_cache.parquet")
+    save_parse_cache(path, parses, hashes)
+
+    loaded = load_parse_cache(path)
+    assert loaded.keys() == parses.keys()
+    for custom_id, parsed in parses.items():
+        assert (loaded[custom_id].tags, loaded[custom_id].starts, loaded[custom_id].ends, loaded[custom_id].prefix_end) \
+            == (parsed.tags, parsed.starts, parsed.ends, parsed.prefix_end)
+    assert load_parse_cache_hashes(path) == hashes
+    assert source_hash("a", "b") != source_hash("a", "c")
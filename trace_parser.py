@@ -0,0 +1,163 @@
+import re
+import hashlib
+from array import array
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TAG_CONTINUE = "<continue_reasoning>"
+TAG_REFLECTION = "<self_reflection>"
+TAG_ALTERNATIVE = "<alternative_approach>"
+
+# 标签编码：0 = CONTINUE, 1/2 = BACKTRACK
+TAGS = (TAG_CONTINUE, TAG_REFLECTION, TAG_ALTERNATIVE)
+TAG_CODES = {tag: code for code, tag in enumerate(TAGS)}
+BACKTRACK_CODES = {TAG_CODES[TAG_REFLECTION], TAG_CODES[TAG_ALTERNATIVE]}
+
+TAG_PATTERN = re.compile(
+    r'<(?:continue_reasoning|self_reflection|alternative_approach)>')
+
+
+class ParsedTrace:
+    """
+    分解后 trace 的紧凑表示：每个 step 的标签编码及其在原始 think 文本中的 [start, end) 偏移。
+
+    - prefix_end: 第一个标签之前的文本在 think 中的结束偏移
+    - 对齐失败 (分解文本与原文不一致) 的 step 及其之后的 step，偏移记为 -1
+    """
+    __slots__ = ("tags", "starts", "ends", "prefix_end")
+
+    def __init__(self, tags=None, starts=None, ends=None, prefix_end: int = 0):
+        self.tags = tags if tags is not None else array("B")
+        self.starts = starts if starts is not None else array("i")
+        self.ends = ends if ends is not None else array("i")
+        self.prefix_end = prefix_end
+
+    def __len__(self):
+        return len(self.tags)
+
+    def block_starts(self) -> List[int]:
+        """
+        思维块的起始 step 下标：BACKTRACK step 开始一个新块；
+        如果 trace 以 CONTINUE steps 开始，则这些 steps 组成第一个思维块。
+        """
+        return [i for i, tag in enumerate(self.tags) if i == 0 or tag in BACKTRACK_CODES]
+
+    def block_end_offset(self, block_index: int) -> Optional[int]:
+        """第 block_index 个思维块在 think 中的结束偏移，未能对齐时返回 None"""
+        starts = self.block_starts()
+        if block_index + 1 < len(starts):
+            last_step = starts[block_index + 1] - 1
+        else:
+            last_step = len(self.tags) - 1
+        end = self.ends[last_step]
+        return end if end >= 0 else None
+
+    def middle_block_end_offset(self) -> Optional[int]:
+        """中间思维块 (索引 (总块数 - 1) // 2) 的结束偏移"""
+        return self.block_end_offset((len(self.block_starts()) - 1) // 2)
+
+
+def parse_decomposed_trace(decomposed_trace: str, think_text: str) -> ParsedTrace:
+    """
+    一次扫描解析 GPT 分解结果中的标签，并把每个 step 对齐到原始 think 文本上。
+
+    对齐时忽略空白字符 (分解结果可能改动了换行)，只比较非空白字符序列；
+    比较在去除空白后的字符串上用 startswith 完成，再映射回原文偏移。
+    """
+    # think 中所有非空白字符的原文位置，以及去除空白后的字符串
+    positions = [i for i, c in enumerate(think_text) if not c.isspace()]
+    compact = "".join(think_text[i] for i in positions)
+
+    parsed = ParsedTrace()
+    cursor = 0          # compact 中已对齐到的位置
+    last_end = 0        # 原文中已对齐到的结束偏移
+    aligned = True
+
+    def align(segment: str):
+        nonlocal cursor, last_end, aligned
+        if not aligned:
+            return -1, -1
+        target = "".join(segment.split())
+        if not target:
+            return last_end, last_end
+        if not compact.startswith(target, cursor):
+            aligned = False
+            return -1, -1
+        start = positions[cursor]
+        cursor += len(target)
+        last_end = positions[cursor - 1] + 1
+        return start, last_end
+
+    matches = list(TAG_PATTERN.finditer(decomposed_trace))
+    if not matches:
+        return parsed
+
+    _, parsed.prefix_end = align(decomposed_trace[:matches[0].start()])
+    for i, match in enumerate(matches):
+        content_end = matches[i + 1].start() if i + 1 < len(matches) else len(decomposed_trace)
+        start, end = align(decomposed_trace[match.end():content_end])
+        parsed.tags.append(TAG_CODES[match.group()])
+        parsed.starts.append(start)
+        parsed.ends.append(end)
+    return parsed
+
+
+def step_texts(parsed: ParsedTrace, think_text: str) -> List[str]:
+    """按偏移从原文切出每个 step 的文本 (未对齐的 step 为空字符串)"""
+    return [think_text[start:end] if start >= 0 else ""
+            for start, end in zip(parsed.starts, parsed.ends)]
+
+
+PARSE_CACHE_SCHEMA = pa.schema([
+    ("custom_id", pa.string()),
+    ("tags", pa.list_(pa.uint8())),
+    ("starts", pa.list_(pa.int32())),
+    ("ends", pa.list_(pa.int32())),
+    ("prefix_end", pa.int32()),
+    ("source_hash", pa.string()),
+])
+
+
+def source_hash(decomposed_trace: str, think_text: str) -> str:
+    """解析输入 (分解结果 + think 原文) 的摘要，用于判断缓存中的解析结果是否过期"""
+    digest = hashlib.sha1(decomposed_trace.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(think_text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def save_parse_cache(path: str, parses: Dict[str, ParsedTrace], source_hashes: Optional[Dict[str, str]] = None):
+    """
+    把解析结果以列式 (Parquet) 格式持久化，供插入策略与分析脚本复用。
+    source_hashes 为每个 custom_id 的 source_hash，读取时据此只重新解析输入发生变化或缺失的记录。
+    """
+    source_hashes = source_hashes or {}
+    table = pa.table({
+        "custom_id": [str(custom_id) for custom_id in parses],
+        "tags": [list(parsed.tags) for parsed in parses.values()],
+        "starts": [list(parsed.starts) for parsed in parses.values()],
+        "ends": [list(parsed.ends) for parsed in parses.values()],
+        "prefix_end": [parsed.prefix_end for parsed in parses.values()],
+        "source_hash": [source_hashes.get(str(custom_id)) for custom_id in parses],
+    }, schema=PARSE_CACHE_SCHEMA)
+    pq.write_table(table, path, compression="zstd")
+
+
+def load_parse_cache(path: str) -> Dict[str, ParsedTrace]:
+    table = pq.read_table(path).to_pydict()
+    return {
+        custom_id: ParsedTrace(array("B", tags), array("i", starts), array("i", ends), prefix_end)
+        for custom_id, tags, starts, ends, prefix_end in zip(
+            table["custom_id"], table["tags"], table["starts"], table["ends"], table["prefix_end"])
+    }
+
+
+def load_parse_cache_hashes(path: str) -> Dict[str, str]:
+    """缓存中每个 custom_id 的 source_hash (旧版缓存没有该列时返回空字典，即全部视为过期)"""
+    table = pq.read_table(path)
+    if "source_hash" not in table.column_names:
+        return {}
+    return {custom_id: value for custom_id, value in zip(
+        table["custom_id"].to_pylist(), table["source_hash"].to_pylist()) if value is not None}